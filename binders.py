@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+""" Build the print binders: for each group of cue sheets (grouped by the first
+    digit of the filename, as for the print*.sh scripts), concatenate the cue
+    PDFs into <group>.pdf in the cue directory.
+
+    The pages are copied, not re-rendered, and the groups are built in parallel.
+    A group is only rebuilt if its list of cue sheets, or any of the cue sheets
+    themselves, has changed since the binder was last built.
+
+    A cue sheet often appears several times in a group (once for each sharer of
+    the honor); the copies share the same page contents and resources in the
+    binder, so it's hardly any bigger.  Or, with copies=True, each cue sheet is
+    only put in the binder once, and <group>.copies.txt says how many copies of
+    it to print.
+
+    This needs pypdf; without it, build() returns False, and the binders can
+    be built with gs instead, from the print*.sh scripts that
+    generatehonors.py --printscripts writes.
+"""
+
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfWriter = None
+
+manifestfile = '.binders.json'
+
+
+def binderfile(group):
+    return f'{group}.pdf'
+
+
+def copiesfile(group):
+    return f'{group}.copies.txt'
+
+
+def signature(sheets, copies):
+    """Return a hash which changes if the list of files or any of the files does"""
+    h = hashlib.sha256(b'copies\n' if copies else b'')
+    for (fn, digest) in sheets:
+        h.update(f'{fn}:{digest}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def merge(cuedir, group, sheets, copies=False):
+    """Concatenate the files into the group's binder; return (group, number of pages).
+       sheets is a list of (filename, hash); files with the same hash are only read once,
+       and their pages share contents and resources (or, with copies, are only added once)."""
+    writer = PdfWriter()
+    readers = {}
+    for (fn, digest) in sheets:
+        if digest in readers:
+            if copies:
+                continue
+        else:
+            readers[digest] = PdfReader(os.path.join(cuedir, fn))
+        for page in readers[digest].pages:
+            writer.add_page(page)
+    outfn = os.path.join(cuedir, binderfile(group))
+    with open(outfn + '.tmp', 'wb') as f:
+        writer.write(f)
+    os.replace(outfn + '.tmp', outfn)
+    return (group, len(writer.pages))
+
+
+def writecopies(cuedir, group, sheets):
+    """Write the list of how many copies of each cue sheet to print"""
+    counts = {}
+    for (fn, digest, honor, names) in sheets:
+        counts.setdefault(digest, []).append((fn, honor, names))
+    with open(os.path.join(cuedir, copiesfile(group)), 'w', encoding='utf-8') as f:
+        for uses in counts.values():
+            f.write(f'{len(uses)} x {uses[0][0]}\n')
+            for (fn, honor, names) in uses:
+                f.write(f'    {fn} - {honor} - {names}\n')
+
+
+def build(cues, cuesheets, workers=None, copies=False):
+    """Build the binders that need it.  cues is the CueIndex for the cue directory;
+       cuesheets is a dictionary of group: [(filename, honor, names)...].
+       With copies, each cue sheet goes into its binder once, with a list of how many to print.
+       Return False if we can't build binders here."""
+    if PdfWriter is None:
+        return False
+
+    try:
+        with open(os.path.join(cues.cuedir, manifestfile), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    todo = {}
+    for (group, sheets) in sorted(cuesheets.items()):
+        found = []
+        for (fn, honor, names) in sheets:
+            if cues.exists(fn):
+                found.append((fn, cues.get(fn).hash, honor, names))
+            else:
+                print(f'Cannot find {fn} ({honor} - {names}) for binder {binderfile(group)}')
+        if not found:
+            continue
+        if copies:
+            writecopies(cues.cuedir, group, found)
+        files = [(fn, digest) for (fn, digest, honor, names) in found]
+        sig = signature(files, copies)
+        if manifest.get(group) == sig and os.path.exists(os.path.join(cues.cuedir, binderfile(group))):
+            continue
+        todo[group] = (files, sig)
+    cues.save()
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(merge, cues.cuedir, group, files, copies) for (group, (files, sig)) in todo.items()]
+            for job in jobs:
+                (group, pages) = job.result()
+                print(f'Built {binderfile(group)} ({pages} pages)')
+                manifest[group] = todo[group][1]
+        with open(os.path.join(cues.cuedir, manifestfile), 'w') as f:
+            json.dump(manifest, f)
+    return True
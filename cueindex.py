@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+""" An index of the cue sheets, built from one scan of the cue directory.
+
+    For each PDF we know its size and modification time from the scan; its page
+    count and SHA-256 hash are computed the first time they're asked for and
+    saved in the directory (in .cueindex.json), so they're only recomputed when
+    the file changes.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+class CueFile:
+    def __init__(self, index, name, size, mtime):
+        self.index = index
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.pagecount = None
+        self.sha256 = None
+
+    @property
+    def path(self):
+        return os.path.join(self.index.cuedir, self.name)
+
+    @property
+    def pages(self):
+        if self.pagecount is None:
+            if PdfReader:
+                self.pagecount = len(PdfReader(self.path).pages)
+            else:
+                # Good enough for the simple PDFs we have; pypdf knows better
+                with open(self.path, 'rb') as f:
+                    self.pagecount = len(re.findall(rb'/Type\s*/Page(?![a-zA-Z])', f.read()))
+            self.index.dirty = True
+        return self.pagecount
+
+    @property
+    def hash(self):
+        if self.sha256 is None:
+            h = hashlib.sha256()
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            self.sha256 = h.hexdigest()
+            self.index.dirty = True
+        return self.sha256
+
+    def __repr__(self):
+        return f'{self.name}: {self.size} bytes, modified {self.mtime}'
+
+
+class CueIndex:
+    indexfile = '.cueindex.json'
+
+    def __init__(self, cuedir):
+        self.cuedir = cuedir
+        self.files = {}
+        self.dirty = False
+        try:
+            with os.scandir(cuedir) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith('.pdf') and entry.is_file():
+                        st = entry.stat()
+                        self.files[entry.name] = CueFile(self, entry.name, st.st_size, st.st_mtime)
+        except FileNotFoundError:
+            print(f'Cue directory {cuedir} does not exist')
+            return
+
+        # Pick up page counts and hashes we've already computed for unchanged files
+        try:
+            with open(os.path.join(cuedir, self.indexfile), 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            saved = {}
+        for (name, info) in saved.items():
+            cue = self.files.get(name)
+            if cue and cue.size == info['size'] and cue.mtime == info['mtime']:
+                cue.pagecount = info.get('pages')
+                cue.sha256 = info.get('sha256')
+
+    def save(self):
+        """Save the page counts and hashes we've computed, if there are any new ones"""
+        if not self.dirty:
+            return
+        saved = {name: {'size': cue.size, 'mtime': cue.mtime, 'pages': cue.pagecount, 'sha256': cue.sha256}
+                 for (name, cue) in self.files.items() if cue.pagecount is not None or cue.sha256 is not None}
+        with open(os.path.join(self.cuedir, self.indexfile), 'w') as f:
+            json.dump(saved, f)
+        self.dirty = False
+
+    def exists(self, name):
+        return name in self.files
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def path(self, name):
+        return os.path.join(self.cuedir, name)
+
+    def find(self, filename, part):
+        """Return the cue sheet for one part of a divided or shared honor:
+           the part's own file (2020-1.pdf or 2020s-1.pdf) if there is one,
+           or else the honor's file (2020.pdf or 2020s.pdf).
+           Return None if neither exists."""
+        (base, dot, ext) = filename.partition('.')
+        partname = f'{base}-{part}{dot}{ext}'
+        if partname in self.files:
+            return partname
+        if filename in self.files:
+            return filename
+        return None
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+""" Add a footer with the file's name to each of the cue sheets.
+
+    Usage: footers.py [sourcedir [outdir]]
+
+    Each PDF in sourcedir (by default, ~/Dropbox/HHD Cues/nofooters) is copied to
+    outdir (by default, ../parts from sourcedir) with its filename in 14-point
+    Helvetica at the bottom left of every page.
+
+    Files are stamped in parallel, and only if they've changed since they were
+    last stamped (outdir/.footers.json keeps the hash of each source file).
+"""
+
+import os
+import sys
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+sourcedir = os.path.expanduser('~/Dropbox/HHD Cues/nofooters')
+manifestfile = '.footers.json'
+
+
+def pdfstring(s):
+    return '(' + s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+def overlay(text, width=612, height=792):
+    """Return a page with just the footer on it"""
+    writer = PdfWriter()
+    page = writer.add_blank_page(width, height)
+    font = DictionaryObject({NameObject('/Type'): NameObject('/Font'),
+                             NameObject('/Subtype'): NameObject('/Type1'),
+                             NameObject('/BaseFont'): NameObject('/Helvetica'),
+                             NameObject('/Encoding'): NameObject('/WinAnsiEncoding')})
+    page[NameObject('/Resources')] = DictionaryObject(
+        {NameObject('/Font'): DictionaryObject({NameObject('/F1'): writer._add_object(font)})})
+    contents = DecodedStreamObject()
+    contents.set_data(f'BT /F1 14 Tf 50 20 Td {pdfstring(text)} Tj ET'.encode('cp1252', errors='replace'))
+    page[NameObject('/Contents')] = writer._add_object(contents)
+    return page
+
+
+def stamp(sourcedir, outdir, name):
+    """Write outdir/name: sourcedir/name with its footer on every page"""
+    reader = PdfReader(os.path.join(sourcedir, name))
+    writer = PdfWriter()
+    footer = overlay(name)
+    for page in reader.pages:
+        page.merge_page(footer)
+        writer.add_page(page)
+    outfn = os.path.join(outdir, name)
+    with open(outfn + '.tmp', 'wb') as f:
+        writer.write(f)
+    os.replace(outfn + '.tmp', outfn)
+    return name
+
+
+def filehash(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def addfooters(sourcedir, outdir, workers=None):
+    """Stamp the files which have changed; return the number stamped"""
+    os.makedirs(outdir, exist_ok=True)
+    try:
+        with open(os.path.join(outdir, manifestfile), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    todo = {}
+    with os.scandir(sourcedir) as entries:
+        for entry in entries:
+            if not entry.name.lower().endswith('.pdf') or not entry.is_file():
+                continue
+            st = entry.stat()
+            old = manifest.get(entry.name, {})
+            if old.get('size') == st.st_size and old.get('mtime') == st.st_mtime:
+                digest = old['sha256']
+            else:
+                digest = filehash(entry.path)
+            info = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digest}
+            if old.get('sha256') == digest and os.path.exists(os.path.join(outdir, entry.name)):
+                manifest[entry.name] = info
+            else:
+                todo[entry.name] = info
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(stamp, sourcedir, outdir, name) for name in sorted(todo)]
+            for job in jobs:
+                name = job.result()
+                print(f'Stamped {name}')
+                manifest[name] = todo[name]
+    with open(os.path.join(outdir, manifestfile), 'w') as f:
+        json.dump(manifest, f)
+    return len(todo)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sourcedir = sys.argv[1]
+    outdir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(sourcedir, '..', 'parts')
+    count = addfooters(sourcedir, os.path.normpath(outdir))
+    print(f'{count} files stamped')
@@ -9,6 +9,12 @@
   Generate a new spreadsheet with one line per person/couple per honor,
   with a new field for "sharer".
 
+  With --incremental, only the honors whose rows in honors.csv have changed
+  since the last run (because of the assignments, the roster, or the
+  services or master sheets) are listed in the changed-honors manifest for
+  makemail.py --changed, and replaced in the honors database; otherwise,
+  every honor is.
+
 """
 import sys
 
@@ -73,10 +79,10 @@ class Service:
         # Convert the items in the row into attributes of the object
         self.serviceid = row.serviceid
         self.service = normalizeService(row.service)
-        self.date = row.convertSerial(row.date).date()
-        self.time = row.convertSerial(row.time).time()
+        self.date = row.date.date()
+        self.time = row.time.time()
         self.early = int(row.early)
-        self.arrive = row.convertSerial(row.arrive).time()
+        self.arrive = row.arrive.time()
         self.daypart = normalizeService(row.daypart)
         self.rabbi = row.rabbi
         self.location = row.location
@@ -122,6 +128,7 @@ class Honor:
         return self.honors.get(honorid, None)
 
     def assign(self, person):
+        self.sharingcache = None  # The sharing information has to be recomputed
         try:
             self.sharers[person.household_id].addname(person)
         except KeyError:
@@ -140,8 +147,9 @@ class Honor:
                 attrname = 'fromtext'
             elif attrname == 'to':
                 attrname = 'totext'
-            self.__dict__[attrname] = stringify(row.__dict__[x])
+            self.__dict__[attrname] = stringify(getattr(row, x, ''))
         self.sharers = {}  # Indexed by membership ID
+        self.sharingcache = None  # Cached result of sharing()
         self.honorid = self.honorid + self.alternative.strip()
         self.honors[self.honorid] = self
 
@@ -171,14 +179,18 @@ class Honor:
         """ Return a list, with a dict in each position:
       me: me
       them: a comma separated list of other sharers' names, with 'and' at the end
+    The list is computed once and reused until someone else is assigned to the honor.
     """
+        if self.sharingcache is not None:
+            return self.sharingcache
         res = []
         sharers = [self.sharers[k] for k in self.sharers]
         #sharers.sort(key=lambda x: x.dear)
+        names = [sharer.fullnames for sharer in sharers]
         for i in range(len(sharers)):
             entry = {}
             entry['me'] = sharers[i]
-            them = [sharers[j].fullnames for j in range(len(sharers)) if j != i]
+            them = names[:i] + names[i+1:]
             if len(them) == 0:
                 entry['them'] = ''
             elif len(them) == 1:
@@ -189,6 +201,7 @@ class Honor:
                 them[-1] = 'and ' + them[-1]
                 entry['them'] = ', '.join(them)
             res.append(entry)
+        self.sharingcache = res
         return res
 
 
@@ -247,6 +260,33 @@ class Honoree:
             self.emails.append(person.email)
 
 
+# The columns of honors.csv
+honorscolumns = ('Dear', 'Full_Name', 'Family_Address', 'Family_CSZ', 'Email1', 'Email2', 'Send_Paper',
+                 'Service', 'Service_Date', 'Service_Time', 'Location', 'Early', 'Arrive', 'Holiday', 'Rabbi',
+                 'HonorID', 'Honor', 'Book', 'Pages', 'Cue', 'FromText', 'ToText', 'Filename', 'Sharing',
+                 'Explanation', 'Adminname', 'Adminemail', 'President')
+
+# Assignments containing any of these words are handled by the office
+officeonly = ('xxx', 'anniversary', 'confirmation', 'conf', '35+', 'teens', 'birthdays', 'photo')
+
+
+def assignednames(row):
+    """Return the cleaned-up names assigned to an honor in a row of the assignment sheet"""
+    names = []
+    for name in (row.name1, row.name2, row.name3, row.name4, row.name5, row.name6, row.name7, row.name8):
+        if name:
+            name = ' '.join(name.strip().split())
+
+            # Strip 'and team'
+            try:
+                teamptr = name.index(' and team')
+                name = name[:teamptr]
+            except ValueError:
+                pass
+            names.append(name)
+    return names
+
+
 def getLabelsFromSheet(sheet):
     """Returns all of the labels from a spreadsheet as a dict"""
     labels = list(sheet.iter_rows(min_row=1, max_row=1, values_only=True))[0]
@@ -277,16 +317,48 @@ class Student:
 if __name__ == '__main__':
 
     import os
+    import json
+    import hashlib
+    import argparse
     from gsheet import GSheet
     from parms import Parms
+    from cueindex import CueIndex
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only regenerate honors whose assignments have changed since the last run')
+    parser.add_argument('--printscripts', action='store_true',
+                        help='write print*.sh scripts to build the binders with gs, instead of building them')
+    parser.add_argument('--autoassign', action='store_true',
+                        help='assign names not in the roster to the person they surely mean, '
+                             'rather than just listing the match for review')
+    args = parser.parse_args()
 
     parms = Parms()
     os.chdir(parms.datadir)
 
+    # Reuse cached copies of the Google sheets if they haven't changed (or if we're working offline)
+    GSheet.setcache(getattr(parms, 'sheetcache', ''), offline=getattr(parms, 'offline', False))
+    GSheet.setsource(getattr(parms, 'sheetsource', ''))
+
+    # Look at the cue sheet directory once, rather than asking about each file
+    cues = CueIndex(parms.cuedir)
+
+    # Fetch all the sheets we need at once
+    specs = {'services': dict(sheetid=parms.services, sheetname=getattr(parms, 'servicessheetname', ''),
+                              stringify=False,
+                              converters={'date': GSheet.GSheetRow.convertSerial,
+                                          'time': GSheet.GSheetRow.convertSerial,
+                                          'arrive': GSheet.GSheetRow.convertSerial},
+                              valueRenderOption='UNFORMATTED_VALUE', dateTimeRenderOption='SERIAL_NUMBER'),
+             'master': dict(sheetid=parms.honorsmaster),
+             'assignments': dict(sheetid=parms.assignments, sheetname=getattr(parms, 'assignmentsheetname', ''))}
+    if getattr(parms, 'dividedsheetname', ''):
+        specs['divided'] = dict(sheetid=parms.honorsmaster, sheetname=parms.dividedsheetname)
+    sheets = GSheet.fetchmany(parms.apikey, specs)
+
     # We need to load service information first, because that determines whether we use Shabbat files or regular ones.
-    services = GSheet(parms.services, parms.apikey, sheetname=getattr(parms, 'servicessheetname', ''),
-                      stringify=False,
-                      valueRenderOption='UNFORMATTED_VALUE', dateTimeRenderOption='SERIAL_NUMBER')
+    services = sheets['services']
     Service.setlabels(services.labels)
     for row in services:
         Service(row)
@@ -310,7 +382,7 @@ if __name__ == '__main__':
 
     # Load all possible honors from the master file
 
-    master = GSheet(parms.honorsmaster, parms.apikey)
+    master = sheets['master']
     Honor.setlabels(master.labels)
 
     for row in master:
@@ -318,15 +390,18 @@ if __name__ == '__main__':
     # Honor.all has all the honors.
 
     # Process divided readings if we have them this year:
-    sheetname = getattr(parms, 'dividedsheetname', '')
-    if sheetname:
-        dr = GSheet(parms.honorsmaster, parms.apikey, sheetname=sheetname)
-        for row in dr:
+    if 'divided' in sheets:
+        for row in sheets['divided']:
             DividedReading(row)
 
     # Now, process the assignment file:
-    sheetname = getattr(parms, 'assignmentsheetname', '')
-    assignments = GSheet(parms.assignments, parms.apikey, sheetname)
+    assignments = list(sheets['assignments'])
+
+    # Get suggestions for all of the names which aren't in the roster (or students) at once
+    nameindex = People.nameindex()
+    nameindex.resolveall([name for row in assignments for name in assignednames(row)
+                          if name not in People.byname and not Student.findbyname(name)])
+
     for row in assignments:
         if not row.honorid:
             continue  # No honorid for many office-managed roles.
@@ -334,90 +409,80 @@ if __name__ == '__main__':
         if not honor:
             print('Could not find honor', row.honorid)
             continue
-        for name in (row.name1, row.name2, row.name3, row.name4, row.name5, row.name6, row.name7, row.name8):
-            if name:
-                name = ' '.join(name.strip().split())
-
-                # Strip 'and team'
-                try:
-                    teamptr = name.index(' and team')
-                    name = name[:teamptr]
-                except ValueError:
-                    pass
-
-                lname = name.lower()
-                skipme = False
-                for item in ('xxx', 'anniversary', 'confirmation', 'conf', '35+', 'teens', 'birthdays', 'photo'):
-                    skipme = skipme or item in lname.split()
-                if not skipme:
-                    person = People.findbyname(name)
-                    if person:
-                        honor.assign(person)
+        for name in assignednames(row):
+            lname = name.lower()
+            skipme = False
+            for item in officeonly:
+                skipme = skipme or item in lname.split()
+            if not skipme:
+                person = People.findbyname(name)
+                if person:
+                    honor.assign(person)
+                else:
+                    student = Student.findbyname(name)
+                    if student:
+                        p = copy.copy(student.parent1)
+                        p.firstname = student.firstname
+                        p.lastname = student.lastname
+                        p.nickname = student.firstname
+                        if student.email:
+                            p.email = student.email
+                        p.key = student.key
+                        p.displayname = student.key
+                        honor.assign(p)
+                        if student.parent2:
+                            honor.sharers[p.household_id].emails.append(student.parent2.email)
                     else:
-                        student = Student.findbyname(name)
-                        if student:
-                            p = copy.copy(student.parent1)
-                            p.firstname = student.firstname
-                            p.lastname = student.lastname
-                            p.nickname = student.firstname
-                            if student.email:
-                                p.email = student.email
-                            p.key = student.key
-                            p.displayname = student.key
-                            honor.assign(p)
-                            if student.parent2:
-                                honor.sharers[p.household_id].emails.append(student.parent2.email)
+                        sure = nameindex.sure(name)
+                        if sure and args.autoassign:
+                            print(f'{name} not found in roster for Honor {row.honorid} - using {sure.key}')
+                            honor.assign(sure)
                         else:
-                            print(f'{name} not found in roster for Honor {row.honorid} - will send invitation to {parms.adminemail}')
+                            # List the closest people in the roster, so the operator can fix the name
+                            suggestions = ', '.join(f'{p.key} ({score:.2f})'
+                                                    for (score, p) in nameindex.resolve(name, limit=3))
+                            print(f'{name} not found in roster for Honor {row.honorid} - will send invitation to {parms.adminemail}'
+                                  + (f' (perhaps {suggestions}?)' if suggestions else '')
+                                  + (f' - use --autoassign to assign {sure.key}' if sure else ''))
                             (firstname, lastname) = name.split(maxsplit=1)
                             p = People.add_dummy(firstname, lastname, email=parms.adminemail)
                             honor.assign(p)
-                else:
-                    print(f'Honor {row.honorid} ({row.description}) for {name} must be handled by the office.')
+            else:
+                print(f'Honor {row.honorid} ({row.description}) for {name} must be handled by the office.')
+
+    # Find out what each honor's rows were last time (None means we don't know)
+    snapshotfn = getattr(parms, 'assignmentsnapshot', 'assignments.snapshot.json')
+    manifestfn = getattr(parms, 'changedhonors', 'changedhonors.txt')
+    previous = None
+    if args.incremental:
+        try:
+            with open(snapshotfn, 'r') as f:
+                previous = json.load(f)
+        except FileNotFoundError:
+            print('No results from a previous run; regenerating everything')
 
     ## OK, now we can create the updated spreadsheet
     ##   and build the batch file to print the cue sheets
 
     with open(parms.honorscsv,'w') as outfile:
         outcsv = csv.writer(outfile)
-        outcsv.writerow(('Dear',
-                          'Full_Name',
-                          'Family_Address',
-                          'Family_CSZ',
-                          'Email1',
-                          'Email2',
-                          'Send_Paper',
-                          'Service',
-                          'Service_Date',
-                          'Service_Time',
-                          'Location',
-                         'Early',
-                         'Arrive',
-                         'Holiday',
-                         'Rabbi',
-                         'HonorID',
-                         'Honor',
-                         'Book',
-                         'Pages',
-                         'Cue',
-                         'FromText',
-                         'ToText',
-                         'Filename',
-                         'Sharing',
-                         'Explanation',
-                         'Adminname',
-                         'Adminemail',
-                         'President'
-                         ))
+        outcsv.writerow(honorscolumns)
 
         cuesheets = {}
+        honorrows = {}  # Base HonorID: [its rows], to compare with the last run
+        dbrows = []  # (values, sequence, sharer) for the honors database
         gscmd = "gs -sDEVICE=pdfwrite -dPDFSETTINGS=/default -dNOPAUSE -dQUIET -dBATCH -sOutputFile=-"
-        for theHonor in Honor.all:
+        for (sequence, theHonor) in enumerate(Honor.all):
             #print(f'{theHonor.honorid} ({theHonor.honorforletter}): {theHonor.sharing()}')
             if theHonor.honorforletter.lower() == 'none':
                 continue  # Skip honors that don't need letters generated.
 
-            if not theHonor.sharing():
+            honorname = theHonor.honorforletter.strip()
+            if not honorname:
+                honorname = theHonor.description
+
+            sharing = theHonor.sharing()
+            if not sharing:
                 continue  # Skip honors with no assignees
 
             # Figure out page and book.
@@ -433,11 +498,7 @@ if __name__ == '__main__':
 
             theService = Service.services[theHonor.service]
 
-            honorname = theHonor.honorforletter.strip()
-            if not honorname:
-                honorname = theHonor.description
-
-            for (num, s) in enumerate(theHonor.sharing()):
+            for (num, s) in enumerate(sharing):
                 try:
                     email1 = s['me'].emails[0]
                 except IndexError:
@@ -451,7 +512,7 @@ if __name__ == '__main__':
                     s['me'].sendpaper = True
 
                 # Handle divided readings:
-                if len(theHonor.sharing()) > 1:
+                if len(sharing) > 1:
                     if theHonor.honorid in DividedReading.all:
                         dr = DividedReading.all[theHonor.honorid][num]
                         pages = 'page ' + dr.page
@@ -463,13 +524,10 @@ if __name__ == '__main__':
                         fromtext = theHonor.fromtext
                         totext = theHonor.totext
                     if theHonor.filename:
-                        fparts = theHonor.filename.split('.')
-                        fparts[0] = f'{fparts[0]}-{num + 1}'
-                        filename = '.'.join(fparts)
-                        if not os.path.exists(os.path.join(parms.cuedir, filename)):
+                        filename = cues.find(theHonor.filename, num + 1)
+                        if not filename:
                             filename = theHonor.filename
-                            if not os.path.exists(os.path.join(parms.cuedir, filename)):
-                                print(f"Cannot find cuesheet for {filename} or {'.'.join(fparts)}")
+                            print(f"Cannot find cuesheet for {filename} or its part {num + 1}")
                     else:
                         filename = ''
                     honorid = f'{theHonor.honorid}-{num + 1}'
@@ -480,34 +538,37 @@ if __name__ == '__main__':
                     filename = theHonor.filename
                     honorid = theHonor.honorid
 
-                outcsv.writerow((s['me'].dear,
-                                 s['me'].fullnames,
-                                 s['me'].addr,
-                                 s['me'].csz,
-                                 email1,
-                                 email2,
-                                 s['me'].sendpaper,
-                                 theService.service,
-                                 theService.date,
-                                 theService.time,
-                                 theService.location,
-                                 theService.early,
-                                 theService.arrive,
-                                 theService.daypart,
-                                 theService.rabbi,
-                                 honorid,
-                                 honorname.replace('\\u2026', '...'),
-                                 theHonor.book,
-                                 pages,
-                                 cue.replace('\\u2026', '...'),
-                                 fromtext,
-                                 totext,
-                                 filename,
-                                 s['them'],
-                                 theHonor.explanation.replace('\\u2026', '...'),
-                                 parms.adminname,
-                                 parms.adminemail,
-                                 parms.president))
+                values = (s['me'].dear,
+                          s['me'].fullnames,
+                          s['me'].addr,
+                          s['me'].csz,
+                          email1,
+                          email2,
+                          s['me'].sendpaper,
+                          theService.service,
+                          theService.date,
+                          theService.time,
+                          theService.location,
+                          theService.early,
+                          theService.arrive,
+                          theService.daypart,
+                          theService.rabbi,
+                          honorid,
+                          honorname.replace('\\u2026', '...'),
+                          theHonor.book,
+                          pages,
+                          cue.replace('\\u2026', '...'),
+                          fromtext,
+                          totext,
+                          filename,
+                          s['them'],
+                          theHonor.explanation.replace('\\u2026', '...'),
+                          parms.adminname,
+                          parms.adminemail,
+                          parms.president)
+                outcsv.writerow(values)
+                dbrows.append((values, sequence, num))
+                honorrows.setdefault(theHonor.honorid, []).append([str(value) for value in values])
 
                 if theHonor.filename:
                     snum = theHonor.filename[0]
@@ -516,31 +577,55 @@ if __name__ == '__main__':
                     cuesheets[snum].append((theHonor.filename, honorname, s['me'].fullnames))
 
 
-    # Create the honors database
-    if parms.honorsdb:
-        try:
-            os.remove(parms.honorsdb)
-        except FileNotFoundError:
-            pass
-        import subprocess
-        subprocess.run(('sqlite3', parms.honorsdb), input=f'.mode csv\n.import {parms.honorscsv} honors\n',
-                               text=True)
-
-
+    # Work out which honors have changed (None means all of them)
+    digests = {honorid: hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+               for (honorid, rows) in honorrows.items()}
+    changed = None
+    if previous is not None:
+        changed = {honorid for honorid in set(previous) | set(digests) if previous.get(honorid) != digests.get(honorid)}
+        print(f'{len(changed)} honors have changed')
 
-    # Finally, write the printing batch files
-    import codecs
+    # Tell makemail.py which honors are new or changed, and remember these rows for next time
+    with open(manifestfn, 'w') as f:
+        f.write(''.join(f'{honorid}\n' for honorid in honorrows if changed is None or honorid in changed))
+    with open(snapshotfn, 'w') as f:
+        json.dump(digests, f)
 
-    for k in cuesheets:
-        batfile = codecs.open('print%s.sh' % k, 'w', encoding='utf-8')
-        batfile.write('#!/bin/bash\n')
-        batfile.write('cd "../New HHD Cues and Readings"\n')
-        batfile.write('gs -dBATCH -dNOPAUSE -q -sDEVICE=pdfwrite -sOutputFile=%s.pdf \\\n' % k)
-        # cuesheets[k].reverse()
-        for s in cuesheets[k]:
-            batfile.write('    %s\\\n' % s[0])
+    # Create (or update) the honors database
+    if parms.honorsdb:
+        import honorsdb
+        conn = honorsdb.connect(parms.honorsdb, honorscolumns)
+        if changed is None or honorsdb.isempty(conn):
+            honorsdb.write(conn, honorscolumns, dbrows)
+        else:
+            idcol = honorscolumns.index('HonorID')
+            honorsdb.write(conn, honorscolumns, [row for row in dbrows if row[0][idcol].split('-')[0] in changed],
+                           honors=changed)
+            # Honors may have moved in the master sheet even if their rows haven't changed
+            honorsdb.reorder(conn, [(values[idcol], sequence, sharer) for (values, sequence, sharer) in dbrows])
+        conn.close()
+
+
+
+    # Finally, build the binders (or, if asked, write batch files to build them with gs)
+    if args.printscripts:
+        import codecs
+
+        for k in cuesheets:
+            batfile = codecs.open('print%s.sh' % k, 'w', encoding='utf-8')
+            batfile.write('#!/bin/bash\n')
+            batfile.write('cd "../New HHD Cues and Readings"\n')
+            batfile.write('gs -dBATCH -dNOPAUSE -q -sDEVICE=pdfwrite -sOutputFile=%s.pdf \\\n' % k)
+            # cuesheets[k].reverse()
+            for s in cuesheets[k]:
+                batfile.write('    %s\\\n' % s[0])
+
+            batfile.write('\n')
+            for s in cuesheets[k]:
+                batfile.write('# %s - %s - %s\n' % s)
+            batfile.close()
+    else:
+        import binders
+        if not binders.build(cues, cuesheets, copies=getattr(parms, 'bindercopies', False)):
+            print('pypdf is not installed; use --printscripts to write print*.sh scripts to build the binders')
 
-        batfile.write('\n')
-        for s in cuesheets[k]:
-            batfile.write('# %s - %s - %s\n' % s)
-        batfile.close()
@@ -1,60 +1,424 @@
 #!/usr/bin/env python3
 
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError, UnknownApiNameOrVersion
+from googleapiclient.http import build_http
 import re
-from datetime import datetime, date, timedelta
-from itertools import zip_longest
+import os
+import json
+import hashlib
+import threading
+import csv
+from openpyxl import load_workbook
+from datetime import datetime, date, time, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 
 def stringify(value):
     """ Convert values to strings and remove leading/trailing blanks """
-    # Let's normalize everything to strings/unicode strings
-    if isinstance(value, (int, float, bool)):
+    # Let's normalize everything to strings/unicode strings.
+    # Workbooks (see GSheet.setsource) give us numbers, dates and times as themselves.
+    if isinstance(value, float) and value.is_integer():
+        value = '%d' % value
+    elif isinstance(value, (int, float)):
         value = '%s' % value
-    if isinstance(value, bool):
-        value = '1' if value else '0'
     elif isinstance(value, (datetime, date)):
         value = ('%s' % value)[0:10]
+    elif isinstance(value, time):
+        value = value.strftime('%I:%M %p').lstrip('0')
+    elif not isinstance(value, str):
+        value = '%s' % value
     return value.strip()
 
 class GSheet:
     """Makes a Google spreadsheet easier to deal with:"""
     
-    # We return a class with items that match the column labels as normalized
+    # We return rows with attributes that match the column labels as normalized.
+    # Each sheet gets its own row class (see GSheetRow.make) with a slot per label.
     class GSheetRow:
-        def __init__(self, names, values):
-            self.fieldnames = names
-            for (name, value) in zip_longest(names, values, fillvalue=''):
-                self.__dict__[name] = value
-                
+        __slots__ = ()
+        fieldnames = ()  # The labels, in column order
+        aliases = {}     # label: slot name, for labels which can't be attribute names (like '2024')
+
+        @classmethod
+        def make(cls, labels):
+            """Return a row class for a sheet with these labels"""
+            aliases = {}
+            for label in labels:
+                if label and label not in aliases:
+                    aliases[label] = label if label.isidentifier() else 'c_' + label
+            return type('GSheetRow', (cls,), {'__slots__': tuple(aliases.values()),
+                                              'fieldnames': tuple(aliases),
+                                              'aliases': aliases})
+
+        def __init__(self, values):
+            for (name, value) in zip(self.__slots__, values):
+                setattr(self, name, value)
+
+        def __getattr__(self, name):
+            # Only called for names which aren't slots
+            try:
+                return object.__getattribute__(self, self.aliases[name])
+            except KeyError:
+                raise AttributeError(name) from None
+
         def __repr__(self):
-            return ', '.join(["%s = '%s'" % (name, self.__dict__[name]) for name in self.fieldnames])
+            return ', '.join(["%s = '%s'" % (name, getattr(self, name)) for name in self.fieldnames])
 
         @classmethod
         def convertSerial(cls, serial):
-            "Convert 'Serial_Number' to Python datetime"
+            """Convert 'Serial_Number' to Python datetime.
+
+            Local copies of sheets (see GSheet.setsource) may give us dates and
+            times from a workbook, or formatted strings from a CSV file, instead."""
+            if isinstance(serial, datetime):
+                return serial
+            if isinstance(serial, date):
+                return datetime.combine(serial, time())
+            if isinstance(serial, time):
+                return datetime.combine(date(1899, 12, 30), serial)
+            if isinstance(serial, str):
+                serial = serial.strip()
+                try:
+                    serial = float(serial)
+                except ValueError:
+                    for fmt in ('%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y', '%m/%d/%y',
+                                '%I:%M %p', '%I:%M:%S %p', '%H:%M:%S', '%H:%M'):
+                        try:
+                            return datetime.strptime(serial, fmt)
+                        except ValueError:
+                            pass
+                    try:
+                        return datetime.fromisoformat(serial)
+                    except ValueError:
+                        raise ValueError(f"Can't read {serial!r} as a date or time") from None
             return datetime(1899, 12, 30) + timedelta(serial)
-            
-    
 
-    
-    
-    def __init__(self, sheetid, apikey, sheetname=None, stringify=True, **kwargs):
+    # Local cache of fetched values; see setcache()
+    cachedir = ''
+    offline = False
+
+    # API clients, shared by every GSheet in the process; see client()
+    clients = {}
+    clientlock = threading.Lock()
+    threadlocal = threading.local()
+
+    # How many rows to ask for at a time
+    pagesize = 500
+
+    # Local copies of the sheets to use instead of Google; see setsource()
+    source = ''
+
+    @classmethod
+    def setsource(cls, source):
+        """Read sheets from local files instead of from Google.
+
+        source is either a single workbook (.xlsx), whose tabs are used for
+        every spreadsheet, or a directory containing, for each spreadsheet key:
+            <key>.xlsx            a workbook with the spreadsheet's tabs, or
+            <key>.csv             the spreadsheet's first tab, and
+            <key>/<tab name>.csv  its other tabs.
+        snapshot() writes the CSV layout from the live spreadsheets."""
+        cls.source = source
+
+    @classmethod
+    def localrows(cls, sheetid, sheetname):
+        """Yield the rows of a tab from the local copy of a spreadsheet"""
+        if os.path.isdir(cls.source):
+            workbook = os.path.join(cls.source, sheetid + '.xlsx')
+            if not os.path.exists(workbook):
+                if sheetname:
+                    fn = os.path.join(cls.source, sheetid, sheetname + '.csv')
+                else:
+                    fn = os.path.join(cls.source, sheetid + '.csv')
+                with open(fn, 'r', encoding='utf-8', newline='') as f:
+                    for row in csv.reader(f):
+                        yield row
+                return
+        else:
+            workbook = cls.source
+
+        wb = load_workbook(workbook, read_only=True, data_only=True)
+        try:
+            if not sheetname:
+                ws = wb.worksheets[0]
+            else:
+                matches = [name for name in wb.sheetnames if name.lower() == sheetname.lower()]
+                if not matches:
+                    raise ValueError(f'No tab named {sheetname} in {workbook}')
+                ws = wb[matches[0]]
+            for row in ws.iter_rows(values_only=True):
+                yield ['' if value is None else value for value in row]
+        finally:
+            wb.close()
+
+    @classmethod
+    def snapshot(cls, sheetid, apikey, directory):
+        """Save every tab of a live spreadsheet as CSV files in the layout setsource() expects"""
+        sheetid = cls.sheetkey(sheetid)
+        service = cls.client('sheets', 'v4', apikey)
+        request = service.spreadsheets().get(spreadsheetId=sheetid, fields='sheets.properties.title')
+        titles = [sheet['properties']['title'] for sheet in request.execute(http=cls.http())['sheets']]
+        os.makedirs(os.path.join(directory, sheetid), exist_ok=True)
+        rows = cls.fetch(sheetid, apikey, titles, {})
+        for (n, (title, tabrows)) in enumerate(zip(titles, rows)):
+            fns = [os.path.join(directory, sheetid, title + '.csv')]
+            if n == 0:
+                fns.append(os.path.join(directory, sheetid + '.csv'))
+            tabrows = list(tabrows)
+            for fn in fns:
+                with open(fn, 'w', encoding='utf-8', newline='') as f:
+                    csv.writer(f).writerows(tabrows)
+
+    @classmethod
+    def setcache(cls, cachedir, offline=False):
+        """Keep a copy of every sheet we fetch in cachedir.
+
+        A cached copy is reused as long as the spreadsheet's Drive revision
+        hasn't changed.  In offline mode, the cache is used without asking
+        Google anything at all (and it's an error if a sheet isn't cached)."""
+        cls.cachedir = cachedir
+        cls.offline = bool(offline)
+        if cachedir:
+            os.makedirs(cachedir, exist_ok=True)
+
+    @classmethod
+    def cachefile(cls, sheetid, sheetname, options):
+        """Return the name of the cache file for this sheet, tab, and set of render options"""
+        key = json.dumps([sheetid, sheetname or '', sorted(options.items())])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cls.cachedir, f'{sheetid}-{digest}.json')
+
+    @classmethod
+    def readcache(cls, fn):
+        """Return (revision, rows) from a cache file, or (None, None) if there's no usable cache.
+
+        The rows are read from the file as they're needed."""
+        try:
+            f = open(fn, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return (None, None)
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            f.close()
+            return (None, None)
+
+        def rows():
+            with f:
+                for line in f:
+                    yield json.loads(line)
+        return (header.get('revision'), rows())
+
+    @classmethod
+    def writecache(cls, fn, revision, rows):
+        """Pass the rows through, writing them to the cache one per line as they go by.
+
+        The cache is only written if all of the rows are read; if the reader
+        stops early (or something fails), the partial copy is thrown away."""
+        tmpfn = fn + '.tmp'
+        complete = False
+        try:
+            with open(tmpfn, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'revision': revision}) + '\n')
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+                    yield row
+            complete = True
+        finally:
+            if complete:
+                os.replace(tmpfn, fn)
+            elif os.path.exists(tmpfn):
+                os.remove(tmpfn)
+
+    @classmethod
+    def client(cls, api, version, apikey):
+        """Return the process-wide client for a Google API, building it the first time.
+
+        The discovery document is the copy bundled with googleapiclient, so
+        building a client doesn't need the network; only if the API isn't
+        bundled (and we're not offline) is it fetched from Google."""
+        key = (api, version, apikey)
+        with cls.clientlock:
+            if key not in cls.clients:
+                try:
+                    cls.clients[key] = discovery.build(api, version, developerKey=apikey, static_discovery=True)
+                except UnknownApiNameOrVersion:
+                    if cls.offline:
+                        raise
+                    cls.clients[key] = discovery.build(api, version, developerKey=apikey, static_discovery=False)
+            return cls.clients[key]
+
+    @classmethod
+    def http(cls):
+        """Return this thread's HTTP connection; the shared clients' own connection isn't thread-safe"""
+        if not hasattr(cls.threadlocal, 'http'):
+            cls.threadlocal.http = build_http()
+        return cls.threadlocal.http
+
+    @classmethod
+    def revision(cls, sheetid, apikey):
+        """Return the spreadsheet's current Drive revision, or None if we can't find out"""
+        try:
+            drive = cls.client('drive', 'v3', apikey)
+            return drive.files().get(fileId=sheetid, fields='version').execute(http=cls.http()).get('version')
+        except HttpError:
+            return None
+
+    @classmethod
+    def sheetkey(cls, sheetid):
+        """Return the spreadsheet key, even if we were given the whole URL"""
         if '/' in sheetid:
-            # Have a whole URL; get the key
             sheetid = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', sheetid).groups()[0]
-            
-        service = discovery.build('sheets', 'v4', developerKey=apikey)
-        range = 'a1:zz999'
-        if sheetname:
-            range = sheetname + '!' + range
-        request = service.spreadsheets().values().get(spreadsheetId=sheetid, range=range, **kwargs)
-        self.values = request.execute()['values']
+        return sheetid
+
+    @classmethod
+    def a1range(cls, title, firstrow, lastrow):
+        """Return the A1 notation for a block of whole rows in a tab (or the first tab, if no title)"""
+        if not title:
+            return "%d:%d" % (firstrow, lastrow)
+        return "'%s'!%d:%d" % (title.replace("'", "''"), firstrow, lastrow)
+
+    @classmethod
+    def rangeend(cls, a1):
+        """Return (title, last row) for a range the API has sent back, like 'Tab 1'!A1:Z100.
+
+        The API cuts the ranges it sends back off at the end of the tab."""
+        (title, cells) = a1.rsplit('!', 1)
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+        return (title, int(re.search(r'(\d+)$', cells).group(1)))
+
+    @classmethod
+    def pages(cls, sheetid, apikey, options, valuerange):
+        """Yield the rows of a tab, fetching the next page of rows only when we need it.
+
+        valuerange is the API's answer for the first page.  The API leaves off
+        empty rows at the end of each page, so a page with fewer rows than we
+        asked for (or one cut off at the end of the tab) is the last one; a tab
+        shouldn't have a blank row at the end of a page with more rows after it."""
+        service = cls.client('sheets', 'v4', apikey)
+        start = 1
+        while True:
+            page = valuerange.get('values', [])
+            for row in page:
+                yield row
+            (title, end) = cls.rangeend(valuerange['range'])
+            if len(page) < cls.pagesize or end < start + cls.pagesize - 1:
+                return
+            start += cls.pagesize
+            request = service.spreadsheets().values().get(spreadsheetId=sheetid,
+                                                          range=cls.a1range(title, start, start + cls.pagesize - 1),
+                                                          **options)
+            try:
+                valuerange = request.execute(http=cls.http())
+            except HttpError as e:
+                if e.resp.status == 400 and b'exceeds grid limits' in (e.content or b''):
+                    return  # The last page ended exactly at the end of the tab
+                raise
+
+    @classmethod
+    def fetch(cls, sheetid, apikey, sheetnames, options):
+        """Return a list with an iterator over the rows of each of the named tabs of one spreadsheet.
+
+        The first pages of the tabs which aren't in the cache (or whose cached
+        copies are stale) are fetched together in a single batchGet call;
+        later pages are fetched as the rows are consumed."""
+        if cls.source:
+            return [cls.localrows(sheetid, sheetname) for sheetname in sheetnames]
+
+        results = [None] * len(sheetnames)
+        cachefns = [cls.cachefile(sheetid, sheetname, options) for sheetname in sheetnames] if cls.cachedir else []
+        revision = None
+        if cls.cachedir:
+            if not cls.offline:
+                revision = cls.revision(sheetid, apikey)
+            for (i, cachefn) in enumerate(cachefns):
+                (cachedrevision, cachedrows) = cls.readcache(cachefn)
+                if cls.offline:
+                    if cachedrows is None:
+                        raise ValueError(f'Offline, and no cached copy of {sheetid} {sheetnames[i] or ""}')
+                    results[i] = cachedrows
+                elif revision and revision == cachedrevision:
+                    results[i] = cachedrows
+                elif cachedrows is not None:
+                    cachedrows.close()
+        elif cls.offline:
+            raise ValueError('Offline mode requires a cache directory')
+
+        needed = [i for i in range(len(sheetnames)) if results[i] is None]
+        if needed:
+            ranges = [cls.a1range(sheetnames[i], 1, cls.pagesize) for i in needed]
+            service = cls.client('sheets', 'v4', apikey)
+            request = service.spreadsheets().values().batchGet(spreadsheetId=sheetid, ranges=ranges, **options)
+            for (i, valuerange) in zip(needed, request.execute(http=cls.http())['valueRanges']):
+                results[i] = cls.pages(sheetid, apikey, options, valuerange)
+                if cls.cachedir:
+                    results[i] = cls.writecache(cachefns[i], revision, results[i])
+        return results
+
+    @classmethod
+    def fetchmany(cls, apikey, specs):
+        """Fetch several sheets at once.
+
+        specs is a dictionary of name: {keyword arguments for GSheet()};
+        we return a dictionary of name: GSheet.  All the tabs needed from a
+        spreadsheet are fetched in one call, and different spreadsheets are
+        fetched concurrently."""
+        groups = {}
+        for (name, spec) in specs.items():
+            spec = dict(spec)
+            sheetid = cls.sheetkey(spec.pop('sheetid'))
+            sheetname = spec.pop('sheetname', None)
+            spec.pop('stringify', None)
+            spec.pop('converters', None)
+            key = (sheetid, json.dumps(sorted(spec.items())))
+            if key not in groups:
+                groups[key] = (sheetid, spec, [], [])
+            groups[key][2].append(name)
+            groups[key][3].append(sheetname)
+
+        with ThreadPoolExecutor(max_workers=len(groups) or 1) as executor:
+            futures = {key: executor.submit(cls.fetch, sheetid, apikey, sheetnames, options)
+                       for (key, (sheetid, options, names, sheetnames)) in groups.items()}
+            rows = {}
+            for (key, future) in futures.items():
+                rows.update(zip(groups[key][2], future.result()))
+
+        return {name: cls.fromvalues(rows[name], specs[name].get('stringify', True), specs[name].get('converters'),
+                                     cls.isformatted(specs[name]))
+                for name in specs}
+
+    @classmethod
+    def isformatted(cls, options):
+        """Return True if the API will give us every value as a string"""
+        if cls.source:
+            return False
+        return options.get('valueRenderOption', 'FORMATTED_VALUE') == 'FORMATTED_VALUE'
+
+    @classmethod
+    def fromvalues(cls, values, stringify=True, converters=None, formatted=False):
+        """Create a GSheet from rows we already have (or an iterator which will supply them)"""
+        self = cls.__new__(cls)
+        self.setup(values, stringify, converters, formatted)
+        return self
+
+    def __init__(self, sheetid, apikey, sheetname=None, stringify=True, converters=None, **kwargs):
+        rows = self.fetch(self.sheetkey(sheetid), apikey, [sheetname], kwargs)[0]
+        self.setup(rows, stringify, converters, self.isformatted(kwargs))
+
+    def setup(self, rows, wantstrings, converters=None, formatted=False):
+        """Get the labels from the first row and work out how to build each row.
+
+        converters is a dictionary of label: function to apply to that
+        column's values; other columns are stringified (if wantstrings) or
+        left alone.  If the values are all known to be strings already,
+        stringifying is just stripping them."""
+        self.rows = iter(rows)
         self.rownum = 0
-        
-    
+
         # Save the unmodified labels
-        self.origlabels = self.values[0]
+        self.origlabels = next(self.rows, [])
     
         # Now, build the label lookup dictionary
         self.lookup = {}
@@ -62,32 +426,54 @@ class GSheet:
         colnum = 0
         for item in self.origlabels:
             # Normalize the label name: lowercase, and remove non-alphamerics
-            item = re.sub('[\W_]+', '', item.lower())
+            item = re.sub(r'[\W_]+', '', str(item).lower())
             self.lookup[item] = colnum
             self.lookup[colnum] = item
             self.labels.append(item)
             colnum += 1
 
         # Remember whether to stringify
-        self.stringify = stringify
-    
-            
-            
+        self.stringify = wantstrings
+
+        # Build the row class, and decide once how to convert each column.
+        # If a label appears more than once, the last column wins.
+        self.rowclass = self.GSheetRow.make(self.labels)
+        lastcol = {label: colnum for (colnum, label) in enumerate(self.labels)}
+        converters = converters or {}
+        default = (str.strip if formatted else stringify) if wantstrings else None
+        self.columns = [(lastcol[label], converters.get(label, default)) for label in self.rowclass.fieldnames]
+
     def __iter__(self):
         return self
-    
-            
+
     def __next__(self):
+        self.row = next(self.rows)
         self.rownum += 1
-        if self.rownum >= len(self.values):
-            raise StopIteration
-        else:
-            self.row = self.values[self.rownum]
-            if self.stringify:
-                return self.GSheetRow(self.labels, [stringify(item) for item in self.row])
-            else:
-                return self.GSheetRow(self.labels, self.row)
-
+        n = len(self.row)
+        try:
+            return self.rowclass([('' if i >= n else self.row[i] if conv is None else conv(self.row[i]))
+                                  for (i, conv) in self.columns])
+        except (ValueError, TypeError, AttributeError):
+            # Say which cell it was
+            for (i, conv) in self.columns:
+                if conv is not None and i < n:
+                    try:
+                        conv(self.row[i])
+                    except (ValueError, TypeError, AttributeError) as e:
+                        raise ValueError(f'Row {self.rownum + 1}, column {self.origlabels[i]}: {e}') from None
+            raise
 
 
-            
\ No newline at end of file
+if __name__ == '__main__':
+    # Save local copies of all of the spreadsheets named in honors.yaml
+    import sys
+    from parms import Parms
+    parms = Parms()
+    directory = sys.argv[1] if len(sys.argv) > 1 else getattr(parms, 'sheetsource', '')
+    if not directory:
+        sys.exit('Usage: gsheet.py directory (or set sheetsource in honors.yaml)')
+    for item in ('services', 'honorsmaster', 'assignments', 'HHDMaster'):
+        sheetid = getattr(parms, item, '')
+        if sheetid:
+            print(f'Saving {item}')
+            GSheet.snapshot(sheetid, parms.apikey, directory)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+""" The honors database: the same rows as honors.csv, but with types and indexes.
+
+    There's one row per letter, keyed by HonorID (e.g. 2020 or 2020-1).  Each row also has:
+      BaseHonorID - the HonorID without any sharer number
+      Sequence    - where the honor is in the master file
+      Sharer      - which sharer of the honor this is (starting with 0)
+    so the rows can be put back in honors.csv order and an honor's rows can be replaced together.
+"""
+
+import sqlite3
+
+# Columns which aren't text
+types = {'Send_Paper': 'INTEGER', 'Early': 'INTEGER', 'Sequence': 'INTEGER', 'Sharer': 'INTEGER'}
+
+schemaversion = 1
+
+# How many HonorIDs to look for in one query
+batchsize = 300
+
+
+def connect(fn, columns):
+    """Open the database, creating (or re-creating) the honors table if it isn't what we expect.
+       columns are the columns of honors.csv."""
+    conn = sqlite3.connect(fn)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != schemaversion:
+        # An old-style (or empty) database; start over.
+        conn.execute('DROP TABLE IF EXISTS honors')
+        decls = ',\n    '.join(f'{name} {types.get(name, "TEXT")}'
+                               for name in list(columns) + ['BaseHonorID', 'Sequence', 'Sharer'])
+        conn.execute(f'CREATE TABLE honors (\n    {decls},\n    UNIQUE (HonorID))')
+        conn.execute('CREATE INDEX honors_base ON honors (BaseHonorID)')
+        conn.execute('CREATE INDEX honors_service ON honors (Service)')
+        conn.execute('CREATE INDEX honors_email1 ON honors (Email1)')
+        conn.execute('CREATE INDEX honors_email2 ON honors (Email2)')
+        conn.execute('CREATE INDEX honors_order ON honors (Sequence, Sharer)')
+        conn.execute(f'PRAGMA user_version = {schemaversion}')
+        conn.commit()
+    return conn
+
+
+def isempty(conn):
+    return conn.execute('SELECT COUNT(*) FROM honors').fetchone()[0] == 0
+
+
+def convert(name, value):
+    """Convert a value (perhaps read back from honors.csv) to the column's type"""
+    if types.get(name) == 'INTEGER':
+        if value in ('True', 'False'):
+            return int(value == 'True')
+        if isinstance(value, str):
+            return int(value) if value.strip() else None
+        return int(value)
+    return value
+
+
+def write(conn, columns, rows, honors=None):
+    """Write rows to the database in one transaction.
+       Each row is (values in honors.csv order, sequence, sharer).
+       If honors is None, the rows replace everything; otherwise, they replace (or add to)
+       the rows for those base HonorIDs, and any other rows for those honors are removed."""
+    names = list(columns) + ['BaseHonorID', 'Sequence', 'Sharer']
+    idcol = columns.index('HonorID')
+    data = []
+    for (values, sequence, sharer) in rows:
+        values = [convert(name, value) for (name, value) in zip(columns, values)]
+        data.append(values + [values[idcol].split('-')[0], sequence, sharer])
+
+    updates = ', '.join(f'{name} = excluded.{name}' for name in names if name != 'HonorID')
+    with conn:
+        if honors is None:
+            conn.execute('DELETE FROM honors')
+        else:
+            keep = {row[idcol] for row in data}
+            for base in honors:
+                for (honorid,) in conn.execute('SELECT HonorID FROM honors WHERE BaseHonorID = ?', (base,)).fetchall():
+                    if honorid not in keep:
+                        conn.execute('DELETE FROM honors WHERE HonorID = ?', (honorid,))
+        conn.executemany(f'INSERT INTO honors ({", ".join(names)}) VALUES ({", ".join("?" * len(names))}) '
+                         f'ON CONFLICT (HonorID) DO UPDATE SET {updates}', data)
+
+
+def reorder(conn, order):
+    """Set each row's place in honors.csv; order is a list of (HonorID, sequence, sharer)"""
+    with conn:
+        conn.executemany('UPDATE honors SET Sequence = ?, Sharer = ? WHERE HonorID = ?',
+                         [(sequence, sharer, honorid) for (honorid, sequence, sharer) in order])
+
+
+def astext(name, value):
+    """Convert a value back to the way honors.csv has it"""
+    if value is None:
+        return ''
+    if name == 'Send_Paper':
+        return str(bool(value))
+    return str(value)
+
+
+def find(conn, honorids):
+    """Yield (row, sharer, the previous row's Full_Name) for these HonorIDs (with or without
+       sharer numbers) in honors.csv order; each row is a dictionary, as csv.DictReader would give."""
+    honorids = list(honorids)
+    found = {}  # HonorID: values
+    names = None
+    for start in range(0, len(honorids), batchsize):
+        batch = honorids[start:start + batchsize]
+        marks = ', '.join('?' * len(batch))
+        cur = conn.execute(f'SELECT * FROM (SELECT *, LAG(Full_Name, 1, \'\') OVER (ORDER BY Sequence, Sharer) '
+                           f'AS PreviousName FROM honors) '
+                           f'WHERE HonorID IN ({marks}) OR BaseHonorID IN ({marks})', batch + batch)
+        names = [d[0] for d in cur.description]
+        for values in cur:
+            found[values[names.index('HonorID')]] = values
+    if not found:
+        return
+    order = (names.index('Sequence'), names.index('Sharer'))
+    for values in sorted(found.values(), key=lambda values: (values[order[0]], values[order[1]])):
+        row = dict(zip(names, values))
+        sharer = row['Sharer']
+        prev = row.pop('PreviousName')
+        for extra in ('BaseHonorID', 'Sequence', 'Sharer'):
+            del row[extra]
+        yield ({name: astext(name, value) for (name, value) in row.items()}, sharer, prev or '')
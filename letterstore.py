@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+""" The letters written by makemail.py, kept in one database (letters.db in the
+    mail directory) instead of an .html and a .txt file for each letter.
+
+    Each letter is keyed by its name (its HonorID, with the sharer number if the
+    honor is shared), which is what the files would have been called; sendmail.py
+    looks a letter up here when it's asked for ./NAME.html or ./NAME.txt, and
+    only reads such a file if there's no letter by that name here.
+
+    The outbox table lists the letters to be sent (the same ones as sendem.sh),
+    in order, with their recipients and attachments, for sendall.py.
+"""
+
+import os
+import sqlite3
+
+schemaversion = 2
+
+
+def connect(fn):
+    conn = sqlite3.connect(fn)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != schemaversion:
+        conn.execute('DROP TABLE IF EXISTS letters')
+        conn.execute('DROP TABLE IF EXISTS outbox')
+        conn.execute('CREATE TABLE letters (\n'
+                     '    name TEXT PRIMARY KEY,\n'
+                     '    BaseHonorID TEXT,\n'
+                     '    html TEXT,\n'
+                     '    text TEXT)')
+        conn.execute('CREATE INDEX letters_base ON letters (BaseHonorID)')
+        conn.execute('CREATE TABLE outbox (\n'
+                     '    position INTEGER PRIMARY KEY,\n'
+                     '    name TEXT,\n'
+                     '    sentto TEXT,\n'
+                     '    attachment TEXT)')
+        conn.execute(f'PRAGMA user_version = {schemaversion}')
+        conn.commit()
+    return conn
+
+
+def write(conn, letters, replace=True):
+    """Store letters, a list of (name, html, text), in one transaction.
+       If replace, they replace all the letters already there."""
+    with conn:
+        if replace:
+            conn.execute('DELETE FROM letters')
+        conn.executemany('INSERT OR REPLACE INTO letters (name, BaseHonorID, html, text) VALUES (?, ?, ?, ?)',
+                         [(name, name.split('-')[0], html, text) for (name, html, text) in letters])
+
+
+def writeoutbox(conn, entries):
+    """Replace the outbox with entries, a list of (name, [recipients], attachment or '')"""
+    with conn:
+        conn.execute('DELETE FROM outbox')
+        conn.executemany('INSERT INTO outbox (name, sentto, attachment) VALUES (?, ?, ?)',
+                         [(name, ' '.join(sentto), attachment) for (name, sentto, attachment) in entries])
+
+
+def outbox(conn):
+    """Return the outbox as a list of (name, [recipients], attachment or '')"""
+    return [(name, sentto.split(), attachment)
+            for (name, sentto, attachment) in conn.execute('SELECT name, sentto, attachment FROM outbox ORDER BY position')]
+
+
+def read(conn, name):
+    """Return (html, text) for the letter, or None if there isn't one"""
+    return conn.execute('SELECT html, text FROM letters WHERE name = ?', (name,)).fetchone()
+
+
+def export(conn, directory='.', names=None):
+    """Write NAME.html and NAME.txt for the letters (or all of them) into the directory"""
+    if names is None:
+        rows = conn.execute('SELECT name, html, text FROM letters')
+    else:
+        rows = (row for name in names
+                for row in conn.execute('SELECT name, html, text FROM letters WHERE name = ?', (name,)))
+    for (name, html, text) in rows:
+        with open(os.path.join(directory, name + '.html'), 'w') as f:
+            f.write(html)
+        with open(os.path.join(directory, name + '.txt'), 'w') as f:
+            f.write(text)
+
+
+def readfile(fn, dbfn=None):
+    """Return the contents of a letter file.  The letters database (dbfn, or
+       letters.db in the same directory) comes first, since loose files may be
+       left from earlier runs; a file is only read if the database has no
+       letter by that name."""
+    (name, ext) = os.path.splitext(os.path.basename(fn))
+    dbfn = dbfn or os.path.join(os.path.dirname(fn), 'letters.db')
+    if ext in ('.html', '.txt') and os.path.exists(dbfn):
+        conn = sqlite3.connect(dbfn)
+        row = read(conn, name)
+        conn.close()
+        if row:
+            return row[0] if ext == '.html' else row[1]
+    with open(fn, 'r') as f:
+        return f.read()
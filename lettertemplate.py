@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+""" Letter layouts: a letter's paragraphs, read and compiled once, and rendered as
+    both the HTML and the plain-text alternatives of each letter.
+
+    A layout file is a series of paragraphs separated by blank lines.  In a paragraph:
+      - a line starting with # is a comment
+      - {expression} is replaced by the value of a Python expression, evaluated
+        with the values passed to render() (e.g. {line['Honor']} or {parms.rabbiname})
+      - "if expression:" on a line by itself, at the start of the paragraph,
+        means the paragraph is only included if the expression is true
+      - "if expression: some text" means the text is only included if it's true
+      - "html: some text" is only in the HTML version, and "text: some text"
+        only in the plain-text version; a paragraph with nothing else is only
+        in that version
+    The lines of a paragraph are joined with spaces (any spaces at the start of
+    a line are kept).
+
+    The plain text of each paragraph is the HTML with its tags removed (and
+    each <br> turned into two spaces), wrapped to 72 columns, just as the
+    letters have always been; the tags are removed from the layout when it's
+    compiled, so only the values filled in have to be looked at for each
+    letter.  (So an expression which is shown in the text can't contain "<".)
+"""
+
+import re
+import textwrap
+from string import Formatter
+
+tags = re.compile(r'<.*?>')
+conditional = re.compile(r'^if\s+(.*?):(?:\s+(.*))?$')
+
+
+def striptags(s):
+    # textwrap.fill turns the newlines into spaces
+    return tags.sub('', re.sub(r'<br.*?>', '\n\n', s))
+
+
+class Piece:
+    """One line of a paragraph, compiled for HTML and for text"""
+    def __init__(self, src, name, condition=None, kind=None):
+        self.condition = compile(condition, name, 'eval') if condition else None
+        self.kind = kind  # 'html' or 'text' if it's only in that version
+        self.html = self.compile(src, name, html=True)
+        # Fields inside tags (like the address of a link) go with them
+        self.text = self.compile(striptags(src), name, html=False)
+
+    @staticmethod
+    def compile(src, name, html):
+        """Return a list of literal strings and (code, conversion, spec, html) for the fields"""
+        res = []
+        for (literal, field, spec, conversion) in Formatter().parse(src):
+            if literal:
+                res.append(literal)
+            if field is not None:
+                res.append((compile(field, name, 'eval'), conversion, spec, html))
+        return res
+
+    @staticmethod
+    def render(parts, context):
+        out = []
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                (code, conversion, spec, html) = part
+                value = eval(code, {}, context)
+                if conversion == 'r':
+                    value = repr(value)
+                elif conversion == 's':
+                    value = str(value)
+                value = format(value, spec or '')
+                if not html and '<' in value:
+                    value = striptags(value)
+                out.append(value)
+        return ''.join(out)
+
+    def wanted(self, context):
+        return self.condition is None or eval(self.condition, {}, context)
+
+
+class Paragraph:
+    def __init__(self, lines, name):
+        self.condition = None
+        self.pieces = []
+        for line in lines:
+            m = conditional.match(line.strip())
+            if m and not m.group(2):
+                self.condition = compile(m.group(1), name, 'eval')
+            elif m:
+                self.pieces.append(Piece(m.group(2), name, m.group(1)))
+            elif line.startswith(('html:', 'text:')):
+                self.pieces.append(Piece(line[5:].strip(), name, kind=line[:4]))
+            else:
+                self.pieces.append(Piece(line, name))
+        self.hashtml = any(piece.kind != 'text' for piece in self.pieces)
+        self.hastext = any(piece.kind != 'html' for piece in self.pieces)
+
+    def render(self, context):
+        """Return (HTML, text), either of which is None if it's not in that version,
+           or None if the paragraph isn't wanted"""
+        if self.condition and not eval(self.condition, {}, context):
+            return None
+        pieces = [piece for piece in self.pieces if piece.wanted(context)]
+        html = text = None
+        if self.hashtml:
+            html = ' '.join(Piece.render(piece.html, context) for piece in pieces if piece.kind != 'text')
+        if self.hastext:
+            text = textwrap.fill(' '.join(Piece.render(piece.text, context) for piece in pieces
+                                          if piece.kind != 'html'), 72)
+        return (html, text)
+
+
+class Layout:
+    loaded = {}   # filename: Layout
+
+    head = '<html>\n<body>\n<p>'
+    joiner = '</p>\n<p>'
+    tail = '</p>\n</body>\n</html>\n'
+
+    @classmethod
+    def load(cls, fn):
+        """Return the layout in the file, compiling it the first time it's asked for"""
+        if fn not in cls.loaded:
+            with open(fn, 'r', encoding='utf-8') as f:
+                cls.loaded[fn] = cls(f.read(), fn)
+        return cls.loaded[fn]
+
+    def __init__(self, source, name='<layout>'):
+        self.paragraphs = []
+        lines = []
+        for line in source.splitlines() + ['']:
+            line = line.rstrip()
+            if line.lstrip().startswith('#'):
+                continue
+            if line:
+                lines.append(line)
+            elif lines:
+                self.paragraphs.append(Paragraph(lines, name))
+                lines = []
+
+    def render(self, **context):
+        """Return the (HTML, text) of the letter"""
+        html = []
+        text = []
+        for paragraph in self.paragraphs:
+            res = paragraph.render(context)
+            if res:
+                if res[0] is not None:
+                    html.append(res[0])
+                if res[1] is not None:
+                    text.append(res[1])
+        return (self.head + self.joiner.join(html) + self.tail, '\n\n'.join(text))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" The database of mail we've sent (mail.db), so nobody gets the same letter twice.
+
+    Each row of mailed is a recipient and the letter's HTML and text file names
+    (as given to sendmail.py, e.g. ./2020-1.html and ./2020-1.txt); the three
+    together are unique.  The database is in WAL mode, so several senders can
+    use it at once.
+
+    A sender claims each mail before sending it, by adding its row as 'pending';
+    if the row is already there, someone else has sent it (or is sending it),
+    so two senders never both send it.  Once it's gone the row becomes 'sent';
+    if it couldn't be sent the claim is released so a later run tries again.
+    A 'pending' row left by a sender that died may or may not have gone out,
+    so it's left for a person to check (and delete, to send it again).
+"""
+
+import sqlite3
+
+schemaversion = 2
+
+# How many (recipient, htmlfile, textfile) to check in one query
+batchsize = 300
+
+
+def connect(fn='mail.db', timeout=30):
+    conn = sqlite3.connect(fn, timeout=timeout)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {int(timeout * 1000)}')
+    if conn.execute('PRAGMA user_version').fetchone()[0] != schemaversion:
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS mailed (sentto text, htmlfile text, textfile text)')
+            # Earlier versions could record the same mail more than once
+            conn.execute('DELETE FROM mailed WHERE rowid NOT IN '
+                         '(SELECT MIN(rowid) FROM mailed GROUP BY sentto, htmlfile, textfile)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS mailed_unique ON mailed (sentto, htmlfile, textfile)')
+            if 'status' not in [row[1] for row in conn.execute('PRAGMA table_info(mailed)')]:
+                conn.execute("ALTER TABLE mailed ADD COLUMN status text NOT NULL DEFAULT 'sent'")
+            conn.execute(f'PRAGMA user_version = {schemaversion}')
+    return conn
+
+
+def alreadysent(conn, candidates):
+    """Return the set of (sentto, htmlfile, textfile) in candidates which have already been mailed
+       (or claimed by a sender)"""
+    candidates = list(candidates)
+    res = set()
+    for start in range(0, len(candidates), batchsize):
+        batch = candidates[start:start + batchsize]
+        values = ', '.join(['(?, ?, ?)'] * len(batch))
+        cur = conn.execute(f'WITH c (sentto, htmlfile, textfile) AS (VALUES {values}) '
+                           f'SELECT c.sentto, c.htmlfile, c.textfile FROM c '
+                           f'JOIN mailed USING (sentto, htmlfile, textfile)',
+                           [value for item in batch for value in item])
+        res.update(cur.fetchall())
+    return res
+
+
+def claim(conn, rows):
+    """Claim mail about to be sent; rows are (sentto, htmlfile, textfile).
+       Return the rows claimed, leaving out any which have already been mailed or claimed."""
+    res = []
+    with conn:
+        for row in rows:
+            cur = conn.execute("INSERT OR IGNORE INTO mailed (sentto, htmlfile, textfile, status) "
+                               "VALUES (?, ?, ?, 'pending')", row)
+            if cur.rowcount:
+                res.append(row)
+    return res
+
+
+def release(conn, rows):
+    """Give up claims on mail which couldn't be sent, so it can be tried again"""
+    with conn:
+        conn.executemany("DELETE FROM mailed WHERE sentto = ? AND htmlfile = ? AND textfile = ? "
+                         "AND status = 'pending'", rows)
+
+
+def record(conn, rows):
+    """Record that mail has gone out; rows are (sentto, htmlfile, textfile)"""
+    with conn:
+        conn.executemany("INSERT INTO mailed (sentto, htmlfile, textfile, status) VALUES (?, ?, ?, 'sent') "
+                         "ON CONFLICT (sentto, htmlfile, textfile) DO UPDATE SET status = 'sent'", rows)
@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
 # vim: set fileencoding=utf-8 :
 """ Make the files to be used for email
+
+    Any HonorIDs on the command line limit which letters are sent (an ID without a
+    sharer number, like 1234, means all of its sharers).  --changed adds the
+    honors that generatehonors.py listed in its changed-honors manifest.
+    If there's an honors database, only those letters are rendered, using the
+    database to find them; otherwise, every letter is.
+
+    The letters are rendered in parallel and kept in letters.db in the mail
+    directory (see letterstore.py); --files also writes each one out as NNN.html
+    and NNN.txt.  The letters to send are listed in sendem.sh (one sendmail.py
+    per letter) and in the database's outbox, for sendall.py.
     """
 
 
 import csv
-import re
 import os
-import textwrap
 import sys
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import quote_plus, quote
+from lettertemplate import Layout
+import letterstore
+
+
+def alllines(fn):
+    """Yield (row, sharer, the previous row's Full_Name) for each row of honors.csv"""
+    with open(fn, 'r') as infile:
+        sharer = 0
+        lasthonor = None
+        prevreader = ''
+        for line in csv.DictReader(infile):
+            fullhonor = line['HonorID'].split('-')[0]
+            if fullhonor == lasthonor:
+                sharer += 1
+            else:
+                lasthonor = fullhonor
+                sharer = 0
+            yield (line, sharer, prevreader)
+            prevreader = line['Full_Name']
+
+
+def renderletter(job):
+    """Return (name, HTML, text) for one letter"""
+    (layoutfn, outfn, context) = job
+    return (outfn,) + Layout.load(layoutfn).render(**context)
 
 
 if __name__ == '__main__':
     from parms import Parms
+    from cueindex import CueIndex
     parms = Parms()
     parms.onlydo = sys.argv[1:]
 
@@ -25,9 +62,30 @@ if __name__ == '__main__':
                f'entry.177841022=honordesc'
     
     sourcedir = os.path.dirname(os.path.abspath(__file__))
+    # The pool's workers load the layout after we've changed directory
+    layoutfn = os.path.abspath(getattr(parms, 'letterlayout', '') or os.path.join(sourcedir, 'makemail.letter'))
+    # Attachments are named from the mail directory, so a relative cuedir is relative to it
+    cuedir = os.path.abspath(os.path.join(parms.datadir, parms.maildir, parms.cuedir))
     
     os.chdir(parms.datadir)
-    infile = open(parms.honorscsv, 'r')
+    cues = CueIndex(cuedir)
+    exportfiles = '--files' in parms.onlydo
+    if exportfiles:
+        parms.onlydo.remove('--files')
+    if '--changed' in parms.onlydo:
+        parms.onlydo.remove('--changed')
+        with open(getattr(parms, 'changedhonors', 'changedhonors.txt'), 'r') as f:
+            parms.onlydo.extend(line.strip() for line in f if line.strip())
+        if not parms.onlydo:
+            sys.exit('No honors have changed.')
+    if parms.onlydo and getattr(parms, 'honorsdb', '') and os.path.exists(parms.honorsdb):
+        # Only render the letters we've been asked for
+        import honorsdb
+        dbconn = sqlite3.connect(parms.honorsdb)
+        lines = list(honorsdb.find(dbconn, parms.onlydo))
+        dbconn.close()
+    else:
+        lines = alllines(os.path.abspath(parms.honorscsv))
     try:
         os.mkdir(parms.maildir)
     except FileExistsError:
@@ -38,21 +96,12 @@ if __name__ == '__main__':
     os.chmod('sendem.sh', 0o755)
     batfile.write('#!/bin/bash\n')
     batfile.write('cd "%s"\n' % os.path.join(parms.datadir, parms.maildir))
+    lettersfn = os.path.abspath(getattr(parms, 'lettersdb', '') or 'letters.db')
     batlist = []
-    rdr = csv.DictReader(infile)
-    linenum = 0
-    sharer = 0
-    lasthonor = None
-    prevreader = ''
-    for line in rdr:
-        linenum += 1
+    outbox = []
+    jobs = []
+    for (line, sharer, prevreader) in lines:
         fullhonor = line['HonorID'].split('-')[0]
-        if fullhonor == lasthonor:
-            sharer += 1
-        else:
-            lasthonor = fullhonor
-            sharer = 0
-        outhtml = []
         formurl = mformurl
         formurl = formurl.replace("honortodisplay", quote_plus(f"{line['Honor']} ({line['Service']})"))
         formurl = formurl.replace("name", quote_plus(line['Full_Name']))
@@ -82,90 +131,18 @@ if __name__ == '__main__':
                 subhonor = f" (Part {sharer+1})"
 
 
-        outhtml.append(f'<p>Dear {line["Dear"]},</p>')
-        outhtml.append(
-            f"<p>L'shanah Tovah!  It is my great pleasure to invite you to participate in our High Holy Day services"
-            f" at Shir Hadash"
-            f" with the honor"
-            f" <b>{line['Honor']}{subhonor}</b> at the <b>{line['Service']} Service</b>"
-            f" on <b>{line['Service_Date']}</b>.")
-        if line['Sharing'] and line['Filename']:
-            outhtml.append(f"  You will be sharing this honor with {line['Sharing']}.")
-        outhtml.append('</p>')
-        if shabbatnote:
-            outhtml.append(f"<p>{shabbatnote}</p>")
         if line['HonorID'] >= '8140' and line['HonorID'] < '9000':
             cueexp = line['Cue'] if line['Cue'] else prevreader
-        prevreader = line['Full_Name']
-
-        outhtml.append('<p>I\'m pleased that we are able to recognize your special contribution to the life of our '
-                     'congregation in this way and express our appreciation for your dedication in the past year.</p>')
-        outhtml.append(f'<p>All honors will be conducted in person this year; we cannot accommodate remote honors.</p>')
-        if not 'Kulanu' in line['Service']:
-          outhtml.append(f'<p>A seat will be reserved in the Sanctuary for you in the Honorees Section for the {line["Service"]} Service.  '
-                         f'We request that you sit in your designated seat prior to and <b>after</b> your honor.</p> '
-                         )
-        outhtml.append('\n'.join(
-                 ('<div id="onlyhtml">', "Please let us know if you will be able to accept this honor by:",
-                 '<ul>',
-                 f'<li>Responding at <a href="{formurl}">this link</a>, or</li>',
-                 f'<li>Emailing <a href="mailto:honors@shirhadash.org?subject={emailsub}">honors@shirhadash.org</a></li>'
-                 '</ul>',
-                 '</div>')))
-        outhtml.append(
-                 f'<p>If you have questions about this honor, please contact '
-                 f'<a href="mailto:{parms.rabbiemail}'
-                 f'?subject=Questions%20about%20High%20Holy%20Day%20Honor%20{emailsub}">'
-                 f'{parms.rabbiname}</a>.</p>')
-        outhtml.append(f"<p>On {line['Holiday']}, please arrive at {line['Arrive']} ({line['Early']} minutes before"
-                       f" the beginning of the worship service) in order to meet with {line['Rabbi']},"
-                       f" who will review your participation in the service"
-                       f" and answer questions about seating and cues.</p>")
-        if line['Filename']:
-            outhtml.append('<p>Please remember to print the attached cue sheet '
-                           'and bring it with you to the service.</p>')
-            if cueexp:
-                outhtml.append(f'<p>You will read after {cueexp}.</p>')
-        if line['Explanation']:
-            outhtml.append(f'<p>{line["Explanation"]}</p>')
-        if line['FromText']:
-            outhtml.append(
-                f'<p>Your reading is in <b>{line["Book"]}</b>, <b>{line["Pages"]}</b>.  '
-                f'Read the English from "<b>{line["FromText"]}</b>" to "<b>{line["ToText"]}</b>".</p>')
-        outhtml.append('<p>We anticipate an inspiring and meaningful High Holy Day season.  '
-                       'Thank you for joining with us to add to the special flavor of our services at '
-                       'Congregation Shir Hadash.</p>')
-
-        # Prepare the plain-text alternative.
-        
-        textonly = 'Please email honors@shirhadash.org to let us know if you will be able to accept this honor.'
-        text = [re.sub(r'(?s)<div id="onlyhtml">.*?</div>', textonly, x) for x in outhtml]
-        
-        text = [re.sub(r'<br.*?>', '\n\n', x) for x in text]
-
-        outtext = '\n\n'.join([textwrap.fill(re.sub(r'<.*?>', '', x), 72) for x in text])
-        
-        # Add signatures to both alternatives.
-
-        outhtml.append(f'<p>\n<p><p>Sincerely,</p><p>\n</p><p>{parms.president}<br />President</p>')
-        outtext += f'\n\nSincerely,\n\n{parms.president}, President'
 
         outfn = line['HonorID']
         if line['Sharing'] and '-' not in outfn:
             outfn = f'{outfn}-{sharer+1}'
-        outf = open(outfn+'.html', 'w')
-        outf.write('<html>\n<body>\n<p>')
-        outf.write('</p>\n<p>'.join(outhtml))
-        outf.write('</p>\n</body>\n</html>\n')
-        outf.close()
-        
-        outf = open(outfn+'.txt', 'w')
-        outf.write(outtext)
-        outf.close()
-
-        if parms.onlydo and outfn not in parms.onlydo:
+        if parms.onlydo and outfn not in parms.onlydo and fullhonor not in parms.onlydo:
             continue
 
+        jobs.append((layoutfn, outfn, dict(line=line, parms=parms, subhonor=subhonor, shabbatnote=shabbatnote,
+                                           cueexp=cueexp, formurl=formurl, emailsub=emailsub)))
+
         if parms.onlydo:
             print(f"{outfn}: {line['Full_Name']} - {line['Email1']} {line['Email2']}")
 
@@ -174,15 +151,30 @@ if __name__ == '__main__':
                   f'--YMLfile "{os.path.join(sourcedir, "cshmail.yml")}" ' \
                   f'--to {line["Email1"]} {line["Email2"]} ' \
                   f' --htmlfile ./{outfn}.html ' \
-                  f'--textfile ./{outfn}.txt '
+                  f'--textfile ./{outfn}.txt ' \
+                  f'--lettersdb "{lettersfn}" '
+        attachment = ''
         if line['Filename']:
-            fn = os.path.join(parms.cuedir, line["Filename"])
-            if os.path.exists(fn):
+            fn = cues.path(line["Filename"])
+            if cues.exists(line["Filename"]):
                 outtext += f' --attach "{fn}"'
+                attachment = fn
             else:
-                print(f'Could not find {fn} or {line["Filename"]} in {parms.cuedir}')
+                print(f'Could not find {fn} or {line["Filename"]} in {cuedir}')
         batlist.append(outtext)
-
-    batlist[-1] += ' --sleep 0\n'  # The last entry doesn't need sleep
+        outbox.append((outfn, [email for email in (line['Email1'], line['Email2']) if email], attachment))
+
+    # Render the letters and store them all at once
+    with ProcessPoolExecutor() as pool:
+        letters = list(pool.map(renderletter, jobs, chunksize=max(1, len(jobs) // (4 * (os.cpu_count() or 1)))))
+    conn = letterstore.connect(lettersfn)
+    letterstore.write(conn, letters, replace=not parms.onlydo)
+    letterstore.writeoutbox(conn, outbox)
+    if exportfiles:
+        letterstore.export(conn, names=[name for (name, html, text) in letters])
+    conn.close()
+
+    if batlist:
+        batlist[-1] += ' --sleep 0\n'  # The last entry doesn't need sleep
     batfile.write('\n'.join(batlist))
     batfile.close()
@@ -1,7 +1,19 @@
 #!/usr/bin/env python3
+""" Make the parts (the cue sheets before footers are added) from the pages of the
+    mazchor, as listed in the HHD Master sheet.
 
-import sys, os, gsheet
+    Each part is built here, in parallel; a part is only rebuilt if its row in the
+    sheet or any of its source pages has changed since it was last built.
+    Without pypdf, write makeallparts.sh to do the work instead.
+"""
+
+import sys, os, gsheet, json, hashlib, shutil
+from concurrent.futures import ProcessPoolExecutor
 from parms import Parms
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = None
 mazchor = '/Users/david/Dropbox/HHD Cues/Mishkan HaNefesh'
 rhpages = os.path.join(mazchor, 'Rosh HaShanah')
 ykpages = os.path.join(mazchor, 'Yom Kippur')
@@ -10,10 +22,7 @@ joincmd= '"/System/Library/Automator/Combine PDF Pages.action/Contents/Resources
 
 outdir = os.path.normpath(os.path.join(mazchor,'..','parts'))
 oldparts = '/Users/david/Dropbox/High Holy Day Honors/New HHD Cues and Readings'
-
-parms = Parms()
-
-sheet = gsheet.GSheet(parms.HHDMaster, parms.apikey)
+manifestfile = '.makeparts.json'
 
 def makenum(s):
     if s.strip():
@@ -21,58 +30,117 @@ def makenum(s):
     else:
         return s
 
-def buildcmd(row):
+def planparts(row):
+    """ Return a list of (part filename, [source files]) for this row; if there's more
+        than one source file, the part is their pages joined together. """
 
     honorid = makenum(row.honorid)
-    row.pagestart = makenum(row.pagestart)
-    row.pageend = makenum(row.pageend)
-    row.honorid = row.honorid + row.alternative.strip()
+    pagestart = makenum(row.pagestart)
+    pageend = makenum(row.pageend)
+    name = row.honorid + row.alternative.strip()
 
     # Identify mazchor
     if honorid < 2000:
-        row.mazchor = ''
+        pagedir = ''
     elif honorid < 5000:
-        row.mazchor = rhpages
+        pagedir = rhpages
     else:
-        row.mazchor = ykpages
-    
-    out = []
-    if row.cuesheet:
-        if row.pagestart:
-            if isinstance(row.pageend, int) and (row.pagestart != row.pageend):
-                pages = [row.pagestart, row.pageend]
-                input = ' '.join(['"%s/%0.3d.pdf"' % (row.mazchor, page) for page in pages])
-                out.append('%s -o "%s/%s.pdf" %s' % (joincmd, outdir, row.honorid, input))
-                if row.cuesheet == 's':
-                    out.append('%s -o "%s/%ss.pdf" %s' % (joincmd, outdir, row.honorid, input))
-            else:
-                out.append('cp "%s/%0.3d.pdf" "%s/%s.pdf"' % (row.mazchor, row.pagestart, outdir, row.honorid))
-                if row.cuesheet == 's':
-                    out.append('cp "%s/%0.3d.pdf" "%s/%ss.pdf"' % (row.mazchor, row.pagestart, outdir, row.honorid))
+        pagedir = ykpages
+
+    if not row.cuesheet:
+        return []
+    names = [name + '.pdf']
+    if row.cuesheet == 's':
+        names.append(name + 's.pdf')
+    if pagestart:
+        if isinstance(pageend, int) and pageend > pagestart:
+            pages = range(pagestart, pageend + 1)
         else:
-            out.append('cp "%s/%s.pdf" "%s/"' % (oldparts, row.honorid, outdir))
-            if row.cuesheet == 's':
-                out.append('cp "%s/%ss.pdf" "%s/"' % (oldparts, row.honorid, outdir))
-                
-    if out:
-        return '\n'.join(out) + '\n'
+            pages = [pagestart]
+        sources = [os.path.join(pagedir, '%0.3d.pdf' % page) for page in pages]
+        return [(n, sources) for n in names]
     else:
-        return ''
-                
+        return [(n, [os.path.join(oldparts, n)]) for n in names]
+
+def buildcmd(part):
+    (name, sources) = part
+    if len(sources) > 1:
+        input = ' '.join(['"%s"' % source for source in sources])
+        return 'echo %s -o "%s/%s" %s\n%s -o "%s/%s" %s\n' % (joincmd[1:-1], outdir, name, input,
+                                                              joincmd, outdir, name, input)
+    else:
+        return 'cp "%s" "%s/%s"\n' % (sources[0], outdir, name)
+
+def signature(row, sources):
+    """ A hash which changes if the row or any of the source files does """
+    h = hashlib.sha256(repr((row.honorid, row.alternative, row.cuesheet, row.pagestart, row.pageend)).encode('utf-8'))
+    for source in sources:
+        st = os.stat(source)
+        h.update(f'{source}:{st.st_size}:{st.st_mtime}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+readers = {}  # Each worker keeps the page files it's opened
+
+def makepart(part):
+    (name, sources) = part
+    outfn = os.path.join(outdir, name)
+    if len(sources) == 1:
+        shutil.copyfile(sources[0], outfn + '.tmp')
+    else:
+        writer = PdfWriter()
+        for source in sources:
+            if source not in readers:
+                readers[source] = PdfReader(source)
+            for page in readers[source].pages:
+                writer.add_page(page)
+        with open(outfn + '.tmp', 'wb') as f:
+            writer.write(f)
+    os.replace(outfn + '.tmp', outfn)
+    return name
+
+
+if __name__ == '__main__':
+    parms = Parms()
+    gsheet.GSheet.setcache(getattr(parms, 'sheetcache', ''), offline=getattr(parms, 'offline', False))
+    gsheet.GSheet.setsource(getattr(parms, 'sheetsource', ''))
+
+    sheet = gsheet.GSheet(parms.HHDMaster, parms.apikey)
+    parts = []
+    for row in sheet:
+        parts.extend((part, row) for part in planparts(row))
 
-                
-                
-outfile = open('makeallparts.sh', 'w')
-outfile.write('mkdir "%s"\n' % outdir)
+    if not PdfReader:
+        outfile = open('makeallparts.sh', 'w')
+        outfile.write('mkdir "%s"\n' % outdir)
+        for (part, row) in parts:
+            outfile.write(buildcmd(part))
+        outfile.close()
+        sys.exit('pypdf is not installed; run makeallparts.sh to make the parts')
 
-for row in sheet:
-    c = buildcmd(row)
-    if c:
-        if 'cp' not in c:
-            outfile.write('echo %s\n' %c[1:-1])
-        outfile.write(c)
+    os.makedirs(outdir, exist_ok=True)
+    try:
+        with open(os.path.join(outdir, manifestfile), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
 
+    todo = {}
+    for (part, row) in parts:
+        (name, sources) = part
+        missing = [source for source in sources if not os.path.exists(source)]
+        if missing:
+            print(f'Cannot make {name}: missing {", ".join(missing)}')
+            continue
+        sig = signature(row, sources)
+        if manifest.get(name) != sig or not os.path.exists(os.path.join(outdir, name)):
+            todo[name] = (part, sig)
 
-       
-      
-        
\ No newline at end of file
+    # Keep the parts which use the same pages together, so each worker opens them once
+    work = sorted((part for (part, sig) in todo.values()), key=lambda part: part[1])
+    with ProcessPoolExecutor() as pool:
+        for name in pool.map(makepart, work, chunksize=max(1, len(work) // (4 * (os.cpu_count() or 1)))):
+            print(f'Made {name}')
+            manifest[name] = todo[name][1]
+    with open(os.path.join(outdir, manifestfile), 'w') as f:
+        json.dump(manifest, f)
+    print(f'{len(todo)} parts made; {len(parts) - len(todo)} unchanged or missing')
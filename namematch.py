@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+""" Find roster entries for names which don't exactly match anyone.
+
+    Assignments are typed by hand, so names don't always match the roster:
+    "Bob Smith" for Robert Smith, "Jane Smith" for Jane Smith-Jones, or just
+    a typo.  NameIndex is built once from the roster and returns the people
+    whose names are most like a given name, best first.
+
+    Candidates come from a trigram index over the roster's names; each name
+    is also tried with the first-name synonyms and nicknames we know about.
+"""
+
+import re
+from collections import defaultdict
+
+
+def normalizename(name):
+    """Lowercase, drop punctuation (but keep the word breaks), and squeeze spaces"""
+    return ' '.join(re.sub(r"[^\w\s]+", ' ', name.lower()).split())
+
+
+def trigrams(name):
+    padded = f'  {name} '
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+titles = ('rabbi', 'cantor', 'dr', 'mr', 'mrs', 'ms')
+
+
+class NameIndex:
+    # A match has to be at least this good to be suggested at all...
+    minscore = 0.5
+    # ...and this good, and this much better than the next person, to be used without asking.
+    surescore = 0.85
+    margin = 0.1
+
+    def __init__(self, people, synonyms=(), nicknames=()):
+        """people is an iterable of (name, person); synonyms is a sequence of tuples of
+           interchangeable first names; nicknames is a sequence of
+           (roster first, roster last, first we might see, last we might see)."""
+        self.names = []          # normalized name for each entry
+        self.people = []         # person for each entry
+        self.grams = defaultdict(list)   # trigram: [entry numbers]
+        for (name, person) in people:
+            n = len(self.names)
+            norm = normalizename(name)
+            self.names.append(norm)
+            self.people.append(person)
+            for gram in trigrams(norm):
+                self.grams[gram].append(n)
+
+        self.synonyms = defaultdict(set)
+        for group in synonyms:
+            group = [normalizename(g) for g in group]
+            for g in group:
+                self.synonyms[g].update(group)
+
+        self.nicknames = {}
+        for (first, last, newfirst, newlast) in nicknames:
+            self.nicknames[normalizename(f'{newfirst} {newlast or last}')] = normalizename(f'{first} {last}')
+
+        self.resolved = {}
+
+    def variants(self, name):
+        """Return the ways we should try to spell a (normalized) name"""
+        res = {name}
+        if name in self.nicknames:
+            res.add(self.nicknames[name])
+        words = name.split()
+        while len(words) > 2 and words[0] in titles:
+            words = words[1:]
+            res.add(' '.join(words))
+        if len(words) > 1:
+            # "Barry and Lisa Cheskin" is (at least) Barry Cheskin
+            if 'and' in words[1:-1]:
+                res.add(' '.join(words[:words.index('and')] + words[-1:]))
+            for syn in self.synonyms.get(words[0], ()):
+                res.add(' '.join([syn] + words[1:]))
+        return res
+
+    def score(self, name, entry):
+        """How alike are a name and an entry's name (1.0 is identical)"""
+        other = self.names[entry]
+        if name == other:
+            return 1.0
+        words = name.split()
+        owords = other.split()
+        # Same last name and the first name is one of theirs (e.g. "Jane Smith" for "Jane Smith Jones")
+        if len(words) > 1 and words[0] == owords[0] and words[-1] in owords[1:]:
+            return 0.95
+        mine = trigrams(name)
+        theirs = trigrams(other)
+        return 2 * len(mine & theirs) / (len(mine) + len(theirs))
+
+    def resolve(self, name, limit=5):
+        """Return a list of (score, person) for the people most like this name, best first"""
+        norm = normalizename(name)
+        if norm in self.resolved:
+            return self.resolved[norm][:limit]
+        best = {}
+        for variant in self.variants(norm):
+            counts = defaultdict(int)
+            for gram in trigrams(variant):
+                for entry in self.grams.get(gram, ()):
+                    counts[entry] += 1
+            # Only score the entries which share a reasonable number of trigrams
+            needed = len(trigrams(variant)) * self.minscore / 2
+            for (entry, count) in counts.items():
+                if count >= needed:
+                    score = self.score(variant, entry)
+                    if variant != norm:
+                        score *= 0.98     # A synonym match isn't quite as good as the real thing
+                    person = self.people[entry]
+                    # The same person can be in the roster under several names; only count them once
+                    who = (getattr(person, 'household_id', id(person)), getattr(person, 'firstname', ''))
+                    if score >= self.minscore and score > best.get(who, (0, None))[0]:
+                        best[who] = (score, person)
+        res = sorted(best.values(), key=lambda x: -x[0])
+        self.resolved[norm] = res
+        return res[:limit]
+
+    def resolveall(self, names):
+        """Resolve many names at once; return a dictionary of name: [(score, person)...]"""
+        return {name: self.resolve(name) for name in set(names)}
+
+    def sure(self, name):
+        """Return the person this name must mean, or None if we're not sure"""
+        matches = self.resolve(name)
+        if not matches or matches[0][0] < self.surescore:
+            return None
+        best = matches[0][1]
+        for (score, other) in matches[1:]:
+            # Someone else in the same household doesn't make us any less sure
+            if score > matches[0][0] - self.margin and \
+                    getattr(other, 'household_id', None) != getattr(best, 'household_id', id(best)):
+                return None
+        return best
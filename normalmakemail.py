@@ -4,20 +4,20 @@
 import sys
 import csv
 import datetime
-import re
 import os
-import textwrap
 from urllib.parse import quote_plus, quote
 
 
 
 if  __name__ == '__main__':
     from parms import Parms
+    from lettertemplate import Layout
     parms = Parms()
     mformurl = f"https://docs.google.com/forms/d/e/{parms.responseform}/viewform?usp=pp_url&entry.1032808708=honortodisplay&entry.365808493=name&entry.172610770=service&entry.1586648944=honorid&entry.177841022=honordesc"
     os.chdir(parms.datadir)
     
     sourcedir = os.path.dirname(os.path.abspath(__file__))
+    layout = Layout.load(getattr(parms, 'normallayout', '') or os.path.join(sourcedir, 'normalmakemail.letter'))
     
     infile = open(parms.honorscsv, 'r')
     try:
@@ -34,7 +34,6 @@ if  __name__ == '__main__':
     linenum = 0
     for line in rdr:
         linenum += 1
-        outhtml = []
         formurl = mformurl
         formurl = formurl.replace("honortodisplay",quote_plus("%s (%s)" % (line['Honor'], line['Service'])))
         formurl = formurl.replace("name", quote_plus(line['Full_Name']))
@@ -42,54 +41,11 @@ if  __name__ == '__main__':
         formurl = formurl.replace("honordesc", quote_plus(line['Honor']))
         formurl = formurl.replace("service", quote_plus(line['Service']))
         emailsub = quote('HHD Honor ' + line['HonorID'] + ': ' + line['Honor'] + ' (' + line['Service'] + ')')
-        outhtml.append('<p>Dear %s,</p>' % line['Dear'])
-        parts = ["<p>L'shanah Tovah!  It is my great pleasure to invite you to participate in our High Holy Day services with the honor"]
-        parts.append('<b>%s</b> at <b>%s</b> Services on <b>%s</b> at <b>%s</b>.' % (line['Honor'], line['Service'], line['Service_Date'], line['Location']))
-        if line['Sharing']:
-            parts.append('You will be joined in this honor by %s.' % line['Sharing'])
-        parts.append('</p>')
-        parts.append('<p>I\'m pleased that we are able to recognize your special contribution to the life of our congregation in this way and express our appreciation for your dedication in the past year.</p>')
-        outhtml.append(' '.join(parts))
-        parts = []
-        parts.append('<div id="onlyhtml">')
-        parts.append("Please let us know if you will be able to accept this honor by:")
-        parts.append('<ul>')
-        parts.append('<li>Responding at <a href="%s">this link</a>, or</li>' % formurl)
-        parts.append('<li>Emailing <a href="mailto:honors@shirhadash.org?subject=' + emailsub + '">honors@shirhadash.org</a>, or</li>')
-        parts.append(f'<li>Calling {parms.adminname} at the Temple Office, 408-358-1751 x7.</li>')
-        parts.append('</ul>')
-        parts.append('</div>')
-        parts.append(f'<p>If you have questions about this honor, please contact <a href="mailto:{parms.rabbiemail}?subject=Questions%20about%20High%20Holy%20Day%20Honor%20' + emailsub + '">{parms.rabbiname}</a>.</p>')
-        outhtml.append(' '.join(parts))
-        outhtml.append('<p>On %s, please arrive at %s (%s minutes before the beginning of the worship service) in order to meet with %s, who will review your participation in the service and answer questions about seating and cues.</p>' % (line['Holiday'], line['Arrive'], line['Early'], line['Rabbi']))
-        if line['Filename']:
-            outhtml.append('<p>Please remember to print the attached cue sheet and bring it with you to the service.</p>')
-        if line['Explanation']:
-            outhtml.append('<p>%s</p>' % line['Explanation'])
-        if line['FromText']:
-            outhtml.append('<p>Your reading is in <b>%s</b>, <b>%s</b>.  Read the English from "<b>%s</b>" to "<b>%s</b>".</p>' % (line['Book'], line['Pages'], line['FromText'], line['ToText'])) 
-        outhtml.append('<p>We anticipate an inspiring and meaningful High Holy Day season.  Thank you for joining with us to add to the special flavor of our services at Congregation Shir Hadash.</p>')
-
-        # Prepare the plain-text alternative.
-        
-        textonly = f'Please call {parms.adminname} at the Temple Office, 408-358-1751 x7, to let us know if you will be able to accept this honor.'
-        text = [re.sub(r'<div id="onlyhtml">.*?</div>', textonly, x) for x in outhtml]
-        
-        text = [re.sub(r'<br.*?>', '\n\n', x) for x in text]
-    
-        outtext = '\n\n'.join([textwrap.fill(re.sub(r'<.*?>', '', x),72) for x in text])
-        
-        # Add signatures to both alternatives.
-
-        outhtml.append(f'<p>\n<p><p>Sincerely,</p><p>\n</p><p>{parms.president}<br />President</p>')
-        outtext += f'\n\nSincerely,\n\n{parms.president}, President'
-    
+        (outhtml, outtext) = layout.render(line=line, parms=parms, formurl=formurl, emailsub=emailsub)
 
         outfn = '%03d' % linenum
         outf = open(outfn+'.html', 'w')
-        outf.write('<html>\n<body>\n<p>')
-        outf.write('</p>\n<p>'.join(outhtml))
-        outf.write('</p>\n</body>\n</html>\n')
+        outf.write(outhtml)
         outf.close()
         
         
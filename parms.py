@@ -10,7 +10,10 @@ class Parms:
         # Promote values to attributes
         for item in parms:
             self.contents.append(item)
-            setattr(self, item, os.path.expanduser(parms[item]))
+            value = parms[item]
+            if isinstance(value, str):
+                value = os.path.expanduser(value)
+            setattr(self, item, value)
     
 if __name__ == '__main__':
     parms = Parms()
@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 """People (for HHD, based on ShulCloud data)
 
-Creates an array of people indexed by "firstname lastname", containing their address fields.
-If any names are duplicated, complains.
+Creates indexes of people by internal ID, by "firstname lastname", by household, and by email,
+containing their address fields.  If any names are duplicated, complains (in debug mode).
 
 ShulCloud has ONE record per household, containing all adults in the household.
 
 """
 
 from openpyxl import load_workbook
+import csv
 import re
+import os
+import hashlib
+import pickle
+from namematch import NameIndex
 from datetime import datetime, date
 
 
 
 def getLabelsFromSheet(sheet):
-    """Returns all of the labels from a spreadsheet as a dict
+    """Returns all of the labels from a spreadsheet as a dict (see getLabelsFromRow)"""
+    return getLabelsFromRow([cell.value for cell in sheet[1]])
+
+def getLabelsFromRow(header):
+    """Returns all of the labels from a header row as a dict
      Labels are normalized by converting them to lower case,
         removing any leading "home-",
         removing any "'s"
@@ -25,8 +34,8 @@ def getLabelsFromSheet(sheet):
         We treat 'first_name', 'last_name', and 'id' specially to avoid problems elsewhere in the code.
         """
     labels = []
-    for p in [cell.value for cell in sheet[1]]:
-        p = p.lower()
+    for p in header:
+        p = stringify('' if p is None else p).lower()
         if p.startswith('home-'):
             p = p[5:]
         p = p.replace("'s", "")
@@ -62,6 +71,22 @@ def stringify(value):
 def normalize(value):
     # Convert to string, and get rid of extraneous spaces
     return ' '.join(stringify(value).split())
+
+def readroster(fn):
+    """Yield the rows of a roster (the first row is the labels) as lists of values, one row at a time.
+       A .csv file is read directly; anything else is read as a workbook in read-only mode, so the
+       whole roster is never in memory at once."""
+    if fn.lower().endswith('.csv'):
+        with open(fn, 'r', encoding='utf-8-sig', newline='') as f:
+            for row in csv.reader(f):
+                yield row
+    else:
+        wb = load_workbook(fn, read_only=True, data_only=True)
+        try:
+            for row in wb.active.iter_rows(values_only=True):
+                yield ['' if v is None else v for v in row]
+        finally:
+            wb.close()
     
 class Nickname:
     nicknames = {}
@@ -82,24 +107,28 @@ class Nickname:
             return None
 
         
+    # (roster first, roster last, first we might see, last we might see)
+    known = (('Ivan (Rusty)', 'Gralnik', 'Rusty', ''),
+             ('S. Henry', 'Stern', 'Henry', ''),
+             ('Itzhak', 'Nir', 'Itzik', ''),
+             ('Isabelle', 'Schneider', 'Billee', ''),
+             ('Rebecca Katz', 'Tedesco', 'Rebecca', 'Katz Tedesco'),
+             ('Hugh', 'Seid-Valencia', 'Rabbi Hugh', 'Seid-Valencia'),
+             ('Julia', 'Hartman', 'Julie', ''),
+             ('Marilyn', 'Keelan', 'Lindy', ''),
+             ('Michael', 'Adelman', 'Mickey', ''),
+             ('Jeffrey', 'Segol', 'Jeff', ''),
+             ('Adrian E', 'Cerda', 'Adrian', ''),
+             ('Stephen', 'Jackson', 'Steve', ''),
+             ('Sara', 'Sperling-Mintz', 'Sara', 'Mintz'),
+             ('Barry and Lisa', 'Cheskin', 'Barry', 'Cheskin'),
+             ('Gretchen', 'Sand-Preville', 'Gretchen', 'Preville'))
+
     @classmethod
     def setnicknames(self):
         return
-        Nickname('Ivan (Rusty)', 'Gralnik', 'Rusty')
-        Nickname('S. Henry', 'Stern', 'Henry')
-        Nickname('Itzhak', 'Nir', 'Itzik')
-        Nickname('Isabelle', 'Schneider', 'Billee')
-        Nickname('Rebecca Katz', 'Tedesco', 'Rebecca', 'Katz Tedesco')
-        Nickname('Hugh', 'Seid-Valencia', 'Rabbi Hugh', 'Seid-Valencia')
-        Nickname('Julia', 'Hartman', 'Julie')
-        Nickname('Marilyn', 'Keelan', 'Lindy')
-        Nickname('Michael', 'Adelman', 'Mickey')
-        Nickname('Jeffrey', 'Segol', 'Jeff')
-        Nickname('Adrian E', 'Cerda', 'Adrian')
-        Nickname('Stephen', 'Jackson', 'Steve')
-        Nickname('Sara', 'Sperling-Mintz', 'Sara', 'Mintz')
-        Nickname('Barry and Lisa', 'Cheskin', 'Barry', 'Cheskin')
-        Nickname('Gretchen', 'Sand-Preville', 'Gretchen', 'Preville')
+        for item in self.known:
+            Nickname(*item)
         
         
     def __repr__(self):
@@ -109,7 +138,12 @@ class Nickname:
 class People:
     linenumber = 1
     dummycount = 0
-    people = {}
+    # The indexes, all maintained by register()
+    byid = {}         # internalcontactid: People
+    byname = {}       # "firstname lastname": [People]
+    byhousehold = {}  # household_id: [People]
+    byemail = {}      # email (lowercase): [People]
+    index = None     # See nameindex()
     debug = False
     synonyms = {
                 'dr': 'Drive',
@@ -152,6 +186,7 @@ class People:
                 ('Mady', 'Madeleine'),
                 ('Pat', 'Patricia')
                 )
+    firstnamesyns = namesyns   # Only used to suggest matches (see namematch.py)
     namesyns = ()
                 
     Nickname.setnicknames()
@@ -160,14 +195,31 @@ class People:
     def setlabels(self, labels):
         self.labels = labels
 
+    @classmethod
+    def readrows(self, fn):
+        """Yield each roster row (after the labels) as a dictionary indexed by column label,
+           with the values cleaned up.  Sets the labels from the first row."""
+        rows = readroster(fn)
+        header = next(rows)
+        self.setlabels(getLabelsFromRow(header))
+        names = [self.labels[i] for i in range(len(header))]
+        for inrow in rows:
+            values = [normalize(v) for v in inrow]
+            values.extend([''] * (len(names) - len(values)))
+            yield dict(zip(names, values))
+
     @classmethod
     def getlinenumber(self):
         self.linenumber += 1
         return self.linenumber
 
     @classmethod
-    def loadpeople2(self, fn, debug=False):   # This version is for years with two adults per record
+    def loadpeople2(self, fn, debug=False, snapshot=True):   # This version is for years with two adults per record
         self.debug = debug
+        # Use the snapshot of the parsed roster if there is one (but always parse it when debugging)
+        snapkey = self.snapshotkey(fn, 'loadpeople2') if snapshot and not debug else None
+        if snapkey and self.loadsnapshot(fn, snapkey):
+            return
         commonfields = ('household_id', 'address', 'address2', 'city', 'state', 'zip' )
         personfields = ('email', 'title', 'firstname', 'lastname', 'nickname')
         firstnamecol = personfields.index('firstname')
@@ -176,15 +228,7 @@ class People:
         thefields = personfields + commonfields
         p1fields = ['primary_' + f for f in personfields] + list(commonfields)
         p2fields = ['secondary_' + f for f in personfields] + list(commonfields)
-        s = load_workbook(fn)
-        sheet = s.active
-        self.setlabels(getLabelsFromSheet(sheet))
-        for inrow in sheet.iter_rows(min_row=2):
-            # Clean up the values and put them in a dictionary indexed by column label
-            values = [normalize(v.value) for v in inrow]
-            row = {self.labels[i]: values[i] for i in range(len(values))}
-
-
+        for row in self.readrows(fn):
             # if only the primary in a row has an email, give it to the secondary, too
             if not row['secondary_email']:
                 row['secondary_email'] = row['primary_email']
@@ -194,13 +238,20 @@ class People:
                 altnames = False
                 # Handle firstname synonyms:
                 pinfo = [row[field] for field in fgroup]
-                People(pinfo, thefields)
+                person = People(pinfo, thefields)
                 if  pinfo[nicknamecol] and pinfo[nicknamecol] != pinfo[firstnamecol]:
-                    People(pinfo, thefields, firstname = pinfo[nicknamecol])
+                    self.addalias(person, pinfo[nicknamecol], person.lastname)
+
+        if snapkey:
+            self.savesnapshot(fn, snapkey)
 
     @classmethod
-    def loadpeople(self, fn, debug=False):  # This version is for years with one adult per record
+    def loadpeople(self, fn, debug=False, snapshot=True):  # This version is for years with one adult per record
         self.debug = debug
+        # Use the snapshot of the parsed roster if there is one (but always parse it when debugging)
+        snapkey = self.snapshotkey(fn, 'loadpeople') if snapshot and not debug else None
+        if snapkey and self.loadsnapshot(fn, snapkey):
+            return
         commonfields = ('household_id', 'address', 'address2', 'city', 'state', 'zip')
         personfields = ('email', 'title', 'firstname', 'lastname', 'nickname')
         firstnamecol = personfields.index('firstname')
@@ -208,16 +259,7 @@ class People:
         emailcol = personfields.index('email')
         thefields = personfields + commonfields
         p1fields = [f for f in personfields] + list(commonfields)
-        s = load_workbook(fn)
-        sheet = s.active
-        self.setlabels(getLabelsFromSheet(sheet))
-        for inrow in sheet.iter_rows(min_row=2):
-            # Clean up the values and put them in a dictionary indexed by column label
-            values = [normalize(v.value) for v in inrow]
-            row = {self.labels[i]: values[i] for i in range(len(values))}
-
-
-
+        for row in self.readrows(fn):
             # Load each person, taking firstname synonyms into account
             altnames = False
             # Some years, the data has 'address1' in it; other times, it's 'address'.  Other code wants 'address', so let's force that.
@@ -234,27 +276,129 @@ class People:
                 lastparts.extend(row['lastname'].split('-'))
             if ' ' in row['lastname']:
                 lastparts.extend(row['lastname'].split(' '))
+            # There's one person per row; the parts of the last name are just other ways to find them
+            pinfo = [row[field] for field in p1fields]
+            person = People(pinfo, thefields)
+            firstnames = [person.firstname]
+            if pinfo[nicknamecol] and pinfo[nicknamecol] != pinfo[firstnamecol]:
+                firstnames.append(pinfo[nicknamecol])
             for item in lastparts:  # will include any parts of a hyphenated name
-                row['lastname'] = item.strip()
-                pinfo = [row[field] for field in p1fields]
-                People(pinfo, thefields)
-                if pinfo[nicknamecol] and pinfo[nicknamecol] != pinfo[firstnamecol]:
-                    People(pinfo, thefields, firstname=pinfo[nicknamecol])
+                for firstname in firstnames:
+                    if (firstname, item.strip()) != (person.firstname, person.lastname):
+                        self.addalias(person, firstname, item.strip())
+
+        if snapkey:
+            self.savesnapshot(fn, snapkey)
+
+    # Snapshots of the parsed roster are kept next to the roster, and are only
+    # used if the roster's contents (and the way we load it) haven't changed.
+    snapshotversion = 3
+
+    @classmethod
+    def snapshotkey(self, fn, loader):
+        h = hashlib.sha256()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return (self.snapshotversion, loader, h.hexdigest())
+
+    @classmethod
+    def loadsnapshot(self, fn, key):
+        """Load everybody from the roster's snapshot; return False if there's no current snapshot"""
+        try:
+            with open(fn + '.snapshot', 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if state.get('key') != key:
+            return False
+        self.labels = state['labels']
+        self.linenumber = state['linenumber']
+        for attrs in state['people']:
+            person = People.__new__(People)
+            person.__dict__.update(attrs)
+            self.register(person, byname=False)
+        for (name, entries) in state['names'].items():
+            self.byname[name] = [self.byid[id] if firstname is None else PeopleAlias(self.byid[id], firstname, lastname)
+                                 for (id, firstname, lastname) in entries]
+        return True
+
+    @classmethod
+    def savesnapshot(self, fn, key):
+        state = {'key': key,
+                 'labels': self.labels,
+                 'linenumber': self.linenumber,
+                 'people': [vars(p) for p in self.byid.values()],
+                 'names': {k: [(p.internalcontactid, p.firstname, p.lastname) if isinstance(p, PeopleAlias)
+                               else (p.internalcontactid, None, None) for p in v]
+                           for (k, v) in self.byname.items()}}
+        tmpfn = fn + '.snapshot.tmp'
+        with open(tmpfn, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfn, fn + '.snapshot')
+
+    @classmethod
+    def register(self, person, byname=True, alternate=False):
+        """Add a person to the indexes.  Complain about duplicate names in debug mode,
+           unless this is just an alternate name for someone."""
+        self.byid[person.internalcontactid] = person
+        self.byhousehold.setdefault(person.household_id, []).append(person)
+        if person.email:
+            self.byemail.setdefault(person.email.lower(), []).append(person)
+        if not byname:
+            return
+        # Other names for people don't count as duplicates, and give way to anyone actually named that
+        other = [one for one in self.byname.get(person.key, []) if not isinstance(one, PeopleAlias)]
+        if self.debug and other:
+            if not alternate:
+                print("Duplicate: %s" % person.key)
+                for one in other:
+                    print("  Old: ID=%5s, address=%s" % (one.internalcontactid, one.getaddr()))
+                print("  New: ID=%5s, address=%s" % (person.internalcontactid, person.getaddr()))
+            self.byname[person.key].append(person)
+        else:
+            self.byname[person.key] = [person]
+
+    @classmethod
+    def addalias(self, person, firstname, lastname):
+        """Let someone be found by another name, unless there's already someone by that name"""
+        alias = PeopleAlias(person, firstname, lastname)
+        if alias.key not in self.byname:
+            self.byname[alias.key] = [alias]
+        return alias
 
     @classmethod
     def find(self, id):
         try:
-            return self.people[id]
+            return self.byid[id]
         except KeyError:
             print("Could not find %s" % id)
             return False
+
+    @classmethod
+    def findbyhousehold(self, household_id):
+        """Return everyone in a household (or an empty list)"""
+        return self.byhousehold.get(household_id, [])
+
+    @classmethod
+    def findbyemail(self, email):
+        """Return everyone with this email address (or an empty list)"""
+        return self.byemail.get(email.lower(), [])
             
+    @classmethod
+    def nameindex(self):
+        """Return the index used to suggest people for names that findbyname can't find"""
+        if self.index is None:
+            entries = [(key, person) for (key, people) in self.byname.items() for person in people]
+            self.index = NameIndex(entries, synonyms=self.firstnamesyns, nicknames=Nickname.known)
+        return self.index
+
     @classmethod
     def findbyname(self, key):        
         try:
-            if len(self.people[key]) > 1:
+            if len(self.byname[key]) > 1:
                 print("%s has multiple entries; use ID!" % key)
-            return self.people[key][0]
+            return self.byname[key][0]
         except KeyError:
             # print("Could not find %s" % key)
             return False
@@ -303,24 +447,29 @@ class People:
         self.handlenickname()
         
         self.internalcontactid = self.getlinenumber()
-        self.people[self.internalcontactid] = self
-    
-        
-        if self.debug and self.key in self.people:
-            if not firstname and not lastname:
-                print("Duplicate: %s" % self.key)
-                other = self.people[self.key]
-                for one in other:
-                    print("  Old: ID=%5s, address=%s" % (one.internalcontactid, one.getaddr()))
-                print("  New: ID=%5s, address=%s" % (self.internalcontactid, self.getaddr()))
-            self.people[self.key].append(self)
-        else:
-            self.people[self.key] = [self]
+        self.register(self, alternate=bool(firstname or lastname))
  
     def __rexpr__(self):
         return "display = '%s', first = '%s', last = '%s', address = '%s', email = '%s', sendpaper = %s" % (self.displayname, self.firstname, self.lastname, self.streetaddress, self.email, self.sendpaper)
         
 
+class PeopleAlias:
+    """Another name for someone in the roster (a nickname, or part of a composite last name).
+       It has its own name, and everything else comes from the person."""
+    def __init__(self, person, firstname, lastname):
+        self.person = person
+        self.firstname = firstname
+        self.lastname = lastname
+        self.key = firstname + ' ' + lastname
+        self.displayname = self.key
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have ourselves
+        if name == 'person':
+            raise AttributeError(name)
+        return getattr(self.person, name)
+
+
 if __name__ == "__main__":
     from parms import Parms
     import os
@@ -343,18 +492,13 @@ if __name__ == "__main__":
                 address text, address2 text, city text, state text, zip text, email text)''')
 
     datalist = []
-    for pnum in People.people:
-        person = People.people[pnum]
-        if isinstance(person, People):
-            datalist.append((pnum, person.household_id, person.displayname, person.firstname, person.lastname,
-                             person.address, person.address2, person.city, person.state, person.zip, person.email))
-        elif isinstance(person, list):
-            for each in person:
-                datalist.append((each.key, each.household_id, each.displayname, each.firstname, each.lastname,
-                                 each.address, each.address2, each.city, each.state, each.zip, each.email))
-        else:
-            print(f'{type(person)} is not People or list)\n{person}')
-        #print(person)
+    for (pnum, person) in People.byid.items():
+        datalist.append((pnum, person.household_id, person.displayname, person.firstname, person.lastname,
+                         person.address, person.address2, person.city, person.state, person.zip, person.email))
+    for (key, people) in People.byname.items():
+        for each in people:
+            datalist.append((each.key, each.household_id, each.displayname, each.firstname, each.lastname,
+                             each.address, each.address2, each.city, each.state, each.zip, each.email))
     cur.executemany('''INSERT INTO people VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', datalist)
     conn.commit()
 
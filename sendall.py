@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+""" Send all the letters in the outbox that makemail.py wrote (in letters.db).
+
+    Up to --concurrency messages are sent at once, each over its own session
+    with the mail server (smtplib, in a thread of its own), which is kept for
+    as long as it lasts.  Messages go no faster than --rate per
+    minute (with bursts of up to --burst).  A message the server refuses for
+    now (a 4xx reply) is tried again after a growing delay, up to --retries times;
+    after --maxfailures connection failures in a row, the rest are left unsent.
+    Nobody gets the same letter twice, even with several senders at once (see maildb.py).
+
+    Run this in the mail directory, as sendem.sh does.  smtpsink.py is a local
+    mail server to try it against.
+"""
+import cshparse, time, smtplib, letterstore, asyncio, random, maildb
+from sendmail import addarguments, makemessage, opendb, connect, avoiddups, logsent
+
+
+class TokenBucket:
+    """Allow rate events a minute, with up to burst at once"""
+    def __init__(self, rate, burst=1):
+        self.interval = 60.0 / rate if rate else 0
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def reserve(self):
+        """Claim the next event; return how many seconds to wait before it's allowed"""
+        if not self.interval:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) / self.interval) - 1
+        self.last = now
+        return max(0, -self.tokens * self.interval)
+
+    def take(self):
+        """Wait until an event is allowed"""
+        time.sleep(self.reserve())
+
+
+class Sender:
+    """A mail server connection, made when it's first needed and remade if it's dropped"""
+    def __init__(self, parms):
+        self.parms = parms
+        self.mailconn = None
+        self.sent = 0
+
+    def send(self, targets, msg):
+        """Send the message; return a dictionary of any recipients the server refused"""
+        if self.mailconn and self.parms.persession and self.sent >= self.parms.persession:
+            self.close()
+        for attempt in (1, 2):
+            if not self.mailconn:
+                self.mailconn = connect(self.parms)
+                self.sent = 0
+            try:
+                refused = self.mailconn.sendmail(self.parms.sender, targets, msg)
+                self.sent += 1
+                return refused
+            except smtplib.SMTPServerDisconnected:
+                self.mailconn = None
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.mailconn:
+            try:
+                self.mailconn.quit()
+            except smtplib.SMTPException:
+                pass
+            self.mailconn = None
+
+
+def replycode(e):
+    """Return the SMTP reply code for a failure (0 if the connection failed)"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return min(code for (code, text) in e.recipients.values())
+    return getattr(e, 'smtp_code', 0)
+
+
+async def deliver(parms, jobs, conn):
+    """Send the jobs, each (name, [recipients], [recipients still to get it], attachment),
+       claiming each one in mail.db just before it's sent (and skipping any recipients
+       another sender has claimed) and logging it once it's gone.  Each message is only
+       put together when it's about to be sent.  Return a list of (name, [recipients],
+       reason) for those which failed.
+
+       Recipients the server refuses for now (4xx) are tried again; those it refuses
+       outright (5xx) aren't.  After --maxfailures connection failures in a row, give
+       up on the server, and fail whatever is left rather than keep retrying."""
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    bucket = TokenBucket(parms.rate, parms.burst)
+    downs = 0      # connection failures in a row
+    broken = None  # why we've given up on the server
+    failures = []
+
+    def fail(name, targets, reason):
+        failures.append((name, targets, reason))
+        maildb.release(conn, [(item, f'./{name}.html', f'./{name}.txt') for item in targets])
+
+    async def worker():
+        nonlocal downs, broken
+        sender = Sender(parms)
+        try:
+            while not queue.empty():
+                (name, sentto, targets, attachment) = queue.get_nowait()
+                if broken:
+                    failures.append((name, targets, broken))
+                    continue
+                htmlfile = f'./{name}.html'
+                textfile = f'./{name}.txt'
+                claimed = maildb.claim(conn, [(item, htmlfile, textfile) for item in targets])
+                targets = [item for (item, h, t) in claimed]
+                if not targets:
+                    continue
+                msg = await asyncio.to_thread(makemessage, parms.sender, parms.subject, sentto, [],
+                                              htmlfile, textfile, [attachment] if attachment else [],
+                                              parms.outbox)
+                for attempt in range(parms.retries + 1):
+                    if broken:
+                        fail(name, targets, broken)
+                        break
+                    await asyncio.sleep(bucket.reserve())
+                    code = 0
+                    try:
+                        refused = await asyncio.to_thread(sender.send, targets, msg)
+                        downs = 0
+                    except smtplib.SMTPRecipientsRefused as e:
+                        refused = e.recipients
+                        downs = 0
+                    except (smtplib.SMTPException, OSError) as e:
+                        refused = None
+                        code = replycode(e)
+                        reason = str(e)
+                        if not code:
+                            # Couldn't talk to the server at all
+                            downs += 1
+                            if parms.maxfailures and downs >= parms.maxfailures:
+                                broken = f'gave up on {parms.mailserver} after {downs} ' \
+                                         f'connection failures in a row ({e})'
+                    else:
+                        logsent(conn, [t for t in targets if t not in refused], htmlfile, textfile,
+                                verbose=parms.verbose)
+                    if refused is None:
+                        if code >= 500 or attempt == parms.retries or broken:
+                            fail(name, targets, reason)
+                            break
+                    else:
+                        # Only the recipients refused for now (4xx) are tried again
+                        retry = []
+                        for (item, (itemcode, text)) in refused.items():
+                            if itemcode >= 500 or attempt == parms.retries:
+                                fail(name, [item], str((itemcode, text)))
+                            else:
+                                retry.append(item)
+                        if not retry:
+                            break
+                        targets = retry
+                        reason = f'{", ".join(retry)} refused for now'
+                    delay = parms.backoff * 2 ** attempt * (1 + random.random())
+                    if parms.verbose >= 2:
+                        print(f'{htmlfile}: {reason}; trying again in {delay:.1f} seconds')
+                    await asyncio.sleep(delay)
+        finally:
+            await asyncio.to_thread(sender.close)
+
+    await asyncio.gather(*(worker() for i in range(max(1, parms.concurrency))))
+    return failures
+
+
+def main():
+    parms = cshparse.cshparse(description=__doc__, YMLfile="cshmail.yml", includedbparms=False)
+    addarguments(parms.parser)
+    # These have no defaults here so that they can be set in cshmail.yml (see cshparse.parse)
+    parms.parser.add_argument("--outbox", dest='outbox', default=None,
+                              help='the letters database with the outbox (letters.db)')
+    parms.parser.add_argument("--rate", dest='rate', type=float, default=None,
+                              help='most messages to send a minute (20; 0 for no limit)')
+    parms.parser.add_argument("--burst", dest='burst', type=int, default=None,
+                              help='most messages to send without waiting (1)')
+    parms.parser.add_argument("--persession", dest='persession', type=int, default=None,
+                              help='reconnect after this many messages (0 to keep the connection)')
+    parms.parser.add_argument("--concurrency", dest='concurrency', type=int, default=None,
+                              help='most messages to send at once (1)')
+    parms.parser.add_argument("--retries", dest='retries', type=int, default=None,
+                              help='times to try again after a temporary failure (5)')
+    parms.parser.add_argument("--maxfailures", dest='maxfailures', type=int, default=None,
+                              help='give up after this many connection failures in a row (5; 0 never to give up)')
+    parms.parser.add_argument("--backoff", dest='backoff', type=float, default=None,
+                              help='seconds to wait before the first retry, doubled each time (30)')
+    parms.parse()
+    for (name, default) in (('outbox', 'letters.db'), ('rate', 20), ('burst', 1), ('persession', 0),
+                            ('concurrency', 1), ('retries', 5), ('maxfailures', 5), ('backoff', 30)):
+        if parms.__dict__.get(name) is None:
+            parms.__dict__[name] = default
+    parms.sender = parms.__dict__['from']  # Get around reserved word
+    parms.verbose = parms.verbose - parms.quiet
+
+    letters = letterstore.connect(parms.outbox)
+    outbox = letterstore.outbox(letters)
+    letters.close()
+
+    # Find out who's already had their letters, all at once (each is claimed again just before it's sent)
+    conn = opendb('mail.db')
+    sent = maildb.alreadysent(conn, [(item, f'./{name}.html', f'./{name}.txt')
+                                     for (name, sentto, attachment) in outbox for item in sentto])
+    jobs = []
+    for (name, sentto, attachment) in outbox:
+        htmlfile = f'./{name}.html'
+        textfile = f'./{name}.txt'
+        targets = avoiddups(conn, sentto, htmlfile, textfile, parms.verbose, sent)
+        if not targets:
+            continue
+        if parms.dryrun:
+            logsent(conn, targets, htmlfile, textfile, parms.dryrun, parms.verbose)
+            continue
+        jobs.append((name, sentto, targets, attachment))
+
+    failures = asyncio.run(deliver(parms, jobs, conn))
+    conn.close()
+    for (name, targets, reason) in failures:
+        print(f'Could not send ./{name}.html to {", ".join(targets)}: {reason}')
+
+
+if __name__ == '__main__':
+    main()
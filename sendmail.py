@@ -1,21 +1,23 @@
 #!/usr/bin/env python3
-""" Send an email contained in a file. """
-import cshparse, os, sys, argparse, smtplib, time
+""" Send an email contained in a file (or in the letters database makemail.py writes). """
+import cshparse, os, sys, argparse, smtplib, time, letterstore, maildb
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart 
+from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 
 
-def avoiddups(which):
+def avoiddups(conn, which, htmlfile, textfile, verbose=1, sent=None):
+  """Return the recipients in which who haven't already had this mail.
+     sent is the result of maildb.alreadysent, if it's already been asked."""
+  if sent is None:
+    sent = maildb.alreadysent(conn, [(item, htmlfile, textfile) for item in which])
   res = []
   for item in which:
-    cur.execute(f"SELECT COUNT(*) FROM mailed WHERE sentto = ? AND htmlfile = ? AND textfile = ?", (item, parms.htmlfile, parms.textfile))
-    count = cur.fetchone()[0]
-    if count == 0:
+    if (item, htmlfile, textfile) not in sent:
       res.append(item)
-    elif parms.verbose >= 2:
-      print(f"not duplicating {item} for {parms.htmlfile} ({parms.textfile})")
-  return res  
+    elif verbose >= 2:
+      print(f"not duplicating {item} for {htmlfile} ({textfile})")
+  return res
 
 import collections.abc
 def flatten(l):
@@ -28,122 +30,151 @@ def flatten(l):
             yield el
 
 
-# Handle parameters
-parms = cshparse.cshparse(description=__doc__, YMLfile="cshmail.yml", includedbparms=False)
-parms.parser.add_argument("--htmlfile", dest='htmlfile', default='')
-parms.parser.add_argument("--textfile", dest='textfile', default='')
-parms.parser.add_argument("--mailserver", dest='mailserver')
-parms.parser.add_argument("--mailpw", dest='mailpw')
-parms.parser.add_argument("--mailport", dest='mailport')
-parms.parser.add_argument("--from", dest='from')
-parms.parser.add_argument("--to", dest='to', nargs='+', default=[], action='append')
-parms.parser.add_argument("--cc", dest='cc', nargs='+', default=[], action='append')
-parms.parser.add_argument("--bcc", dest='bcc', nargs='+', default=[], action='append')
-parms.parser.add_argument("--subject", dest='subject', default='Shir Hadash High Holy Day Honor for You')
-parms.parser.add_argument("--attachment", dest='attachment', nargs='+', default=[], action='append')
-parms.parser.add_argument("--dry-run", dest='dryrun', action='store_true')
-parms.parser.add_argument("--sleep", dest='sleep', type=float, default=3)
-parms.parser.add_argument("--verbose", "-v", dest='verbose', default=1, action='count')
-parms.parser.add_argument("--quiet", "-q", dest='quiet', default=0, action='count')
-
-parms.parse()
-parms.sender = parms.__dict__['from']  # Get around reserved word
-
-parms.verbose = parms.verbose - parms.quiet  # Resolve verbosity level
-
-if parms.attachment:
-    # Create wrapper and main message part
-    msg = MIMEMultipart('mixed')
-    alternatives = MIMEMultipart('alternative')
-else:
-    # Just create main message part
-    msg = MIMEMultipart('alternative')
-    alternatives = msg
-
-
-msg['Subject'] = parms.subject
-msg['From'] = parms.sender
-
-# Flatten recipient lists and insert to and cc into the message header
-parms.to = list(flatten(parms.to))
-parms.cc = list(flatten(parms.cc))
-parms.bcc = list(flatten(parms.bcc))
-parms.attachment = list(flatten(parms.attachment))
-msg['To'] = ', '.join(parms.to)
-msg['cc'] = ', '.join(parms.cc)
-
-
-
-
-# Now, create the alternative parts.
-if parms.textfile:
-    part1 = MIMEText(open(parms.textfile, 'r').read(), 'plain')
-    alternatives.attach(part1)
-else:
-    alternatives.attach(MIMEText('This is a multipart message with no plain-text part', 'plain'))
-    
-if parms.htmlfile:
-    part2 = MIMEText(open(parms.htmlfile, 'r').read(), 'html')
-    alternatives.attach(part2)
-    
-if parms.attachment:
-    msg.attach(alternatives)
-    for item in parms.attachment:
-        # PDFs only for now
-        stuff = open(item, 'rb').read()
-        data = MIMEApplication(stuff, 'pdf')
-        data.add_header('Content-Disposition', 'attachment', filename = os.path.basename(item))
-        msg.attach(data)
-
-
-# Convert the message to string format:
-finalmsg = msg.as_string()
-
-# Remove targets who have already gotten this mail:
-import sqlite3
-conn = sqlite3.connect('mail.db')
-cur = conn.cursor()
-cur.execute('CREATE TABLE IF NOT EXISTS mailed (sentto text, htmlfile text, textfile text)')
-
-parms.to = avoiddups(parms.to)
-parms.cc = avoiddups(parms.cc)
-parms.bcc = avoiddups(parms.bcc)
-
-
-
-
-# And send the mail.
-targets = []
-if parms.to:
-    targets.extend(parms.to)
-if parms.cc:
-    targets.extend(parms.cc)
-if parms.bcc:
-    targets.extend(parms.bcc)
-
-
-
-if targets and not parms.dryrun:
-    # Connect to the mail server:
-    mailconn = smtplib.SMTP_SSL(parms.mailserver, parms.mailport)
+def addarguments(parser):
+    """Add the arguments that say how to send mail"""
+    parser.add_argument("--mailserver", dest='mailserver')
+    parser.add_argument("--mailpw", dest='mailpw')
+    parser.add_argument("--mailport", dest='mailport')
+    parser.add_argument("--nossl", dest='nossl', action='store_true',
+                        help="connect without SSL (as to smtpsink.py)")
+    parser.add_argument("--from", dest='from')
+    parser.add_argument("--subject", dest='subject', default='Shir Hadash High Holy Day Honor for You')
+    parser.add_argument("--dry-run", dest='dryrun', action='store_true')
+    parser.add_argument("--verbose", "-v", dest='verbose', default=1, action='count')
+    parser.add_argument("--quiet", "-q", dest='quiet', default=0, action='count')
+
+
+def makemessage(sender, subject, to, cc, htmlfile, textfile, attachments, lettersdb=None):
+    """Return the message, as a string, ready to send.
+       The letter comes from lettersdb if it's there (see letterstore.readfile)."""
+    if attachments:
+        # Create wrapper and main message part
+        msg = MIMEMultipart('mixed')
+        alternatives = MIMEMultipart('alternative')
+    else:
+        # Just create main message part
+        msg = MIMEMultipart('alternative')
+        alternatives = msg
+
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = ', '.join(to)
+    msg['cc'] = ', '.join(cc)
+
+    # Now, create the alternative parts.
+    if textfile:
+        part1 = MIMEText(letterstore.readfile(textfile, lettersdb), 'plain')
+        alternatives.attach(part1)
+    else:
+        alternatives.attach(MIMEText('This is a multipart message with no plain-text part', 'plain'))
+
+    if htmlfile:
+        part2 = MIMEText(letterstore.readfile(htmlfile, lettersdb), 'html')
+        alternatives.attach(part2)
+
+    if attachments:
+        msg.attach(alternatives)
+        for item in attachments:
+            # PDFs only for now
+            stuff = open(item, 'rb').read()
+            data = MIMEApplication(stuff, 'pdf')
+            data.add_header('Content-Disposition', 'attachment', filename = os.path.basename(item))
+            msg.attach(data)
+
+    # Convert the message to string format:
+    return msg.as_string()
+
+
+def opendb(fn='mail.db'):
+    """Open the database of mail we've already sent"""
+    return maildb.connect(fn)
+
+
+def connect(parms):
+    """Connect and log in to the mail server"""
+    if getattr(parms, 'nossl', False):
+        mailconn = smtplib.SMTP(parms.mailserver, parms.mailport)
+    else:
+        mailconn = smtplib.SMTP_SSL(parms.mailserver, parms.mailport)
     mailconn.ehlo()
     mailconn.login(parms.sender, parms.mailpw)
-
-    # and send the mail
-    mailconn.sendmail(parms.sender, targets, finalmsg)
-
-    # and sleep
-    time.sleep(parms.sleep)
-
-# If all went well, log the transaction
-res = []
-for which in (parms.to, parms.cc, parms.bcc):
-  for item in which:
-    res.append((item, parms.htmlfile, parms.textfile))
-    if parms.verbose >= 1:
-      print(f'{"Would send" if parms.dryrun else "Sent"} {parms.htmlfile} {parms.textfile} to {item}')
-
-if res:
-  cur.executemany('INSERT INTO mailed VALUES (?, ?, ?) ', res)
-
-conn.commit()
+    return mailconn
+
+
+def logsent(conn, recipients, htmlfile, textfile, dryrun=False, verbose=1):
+    """Record that the mail went to the recipients (a dry run only says who it would go to)"""
+    res = []
+    for item in recipients:
+      res.append((item, htmlfile, textfile))
+      if verbose >= 1:
+        print(f'{"Would send" if dryrun else "Sent"} {htmlfile} {textfile} to {item}')
+
+    if res and not dryrun:
+      maildb.record(conn, res)
+
+
+def main():
+    # Handle parameters
+    parms = cshparse.cshparse(description=__doc__, YMLfile="cshmail.yml", includedbparms=False)
+    addarguments(parms.parser)
+    parms.parser.add_argument("--htmlfile", dest='htmlfile', default='')
+    parms.parser.add_argument("--textfile", dest='textfile', default='')
+    parms.parser.add_argument("--lettersdb", dest='lettersdb', default=None,
+                              help='the letters database (default: letters.db next to the files)')
+    parms.parser.add_argument("--to", dest='to', nargs='+', default=[], action='append')
+    parms.parser.add_argument("--cc", dest='cc', nargs='+', default=[], action='append')
+    parms.parser.add_argument("--bcc", dest='bcc', nargs='+', default=[], action='append')
+    parms.parser.add_argument("--attachment", dest='attachment', nargs='+', default=[], action='append')
+    parms.parser.add_argument("--sleep", dest='sleep', type=float, default=3)
+
+    parms.parse()
+    parms.sender = parms.__dict__['from']  # Get around reserved word
+
+    parms.verbose = parms.verbose - parms.quiet  # Resolve verbosity level
+
+    # Flatten recipient lists
+    parms.to = list(flatten(parms.to))
+    parms.cc = list(flatten(parms.cc))
+    parms.bcc = list(flatten(parms.bcc))
+    parms.attachment = list(flatten(parms.attachment))
+
+    finalmsg = makemessage(parms.sender, parms.subject, parms.to, parms.cc,
+                           parms.htmlfile, parms.textfile, parms.attachment, parms.lettersdb)
+
+    # Remove targets who have already gotten this mail:
+    conn = opendb('mail.db')
+    sent = maildb.alreadysent(conn, [(item, parms.htmlfile, parms.textfile)
+                                     for item in parms.to + parms.cc + parms.bcc])
+
+    parms.to = avoiddups(conn, parms.to, parms.htmlfile, parms.textfile, parms.verbose, sent)
+    parms.cc = avoiddups(conn, parms.cc, parms.htmlfile, parms.textfile, parms.verbose, sent)
+    parms.bcc = avoiddups(conn, parms.bcc, parms.htmlfile, parms.textfile, parms.verbose, sent)
+
+    # And send the mail.
+    targets = parms.to + parms.cc + parms.bcc
+
+    if targets and not parms.dryrun:
+        # Claim the mail, in case another sender is sending it too
+        claimed = maildb.claim(conn, [(item, parms.htmlfile, parms.textfile) for item in targets])
+        targets = [item for (item, htmlfile, textfile) in claimed]
+
+    if targets and not parms.dryrun:
+        try:
+            # Connect to the mail server:
+            mailconn = connect(parms)
+
+            # and send the mail
+            mailconn.sendmail(parms.sender, targets, finalmsg)
+        except:
+            maildb.release(conn, claimed)
+            raise
+
+        # and sleep
+        time.sleep(parms.sleep)
+
+    # If all went well, log the transaction
+    logsent(conn, targets, parms.htmlfile, parms.textfile, parms.dryrun, parms.verbose)
+
+
+if __name__ == '__main__':
+    main()
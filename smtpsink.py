@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+""" A local SMTP server which accepts mail and throws it away (or saves it), for
+    testing and timing sendall.py without a real mail server.
+
+    Point sendall.py at it with --mailserver localhost --mailport 8025 --nossl
+    (or give the sink --certfile and --keyfile to talk SSL).  Any login is accepted.
+
+    To see how failures are handled, the sink can be told to refuse a fraction of
+    messages temporarily (451) or permanently (550), to drop the connection, or to
+    be slow.  It prints how many messages it's accepted and refused when stopped.
+"""
+import argparse, asyncio, random, ssl, os, time
+
+
+class Sink:
+    def __init__(self, args):
+        self.args = args
+        self.accepted = 0
+        self.refused = 0
+        self.dropped = 0
+        self.sessions = 0
+        self.maxsessions = 0
+        self.started = None
+
+    async def session(self, reader, writer):
+        self.sessions += 1
+        self.maxsessions = max(self.maxsessions, self.sessions)
+        if self.started is None:
+            self.started = time.monotonic()
+
+        async def reply(line):
+            writer.write(line.encode('ascii') + b'\r\n')
+            await writer.drain()
+
+        try:
+            await reply('220 smtpsink ready')
+            recipients = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+                if verb == 'EHLO':
+                    writer.write(b'250-smtpsink\r\n250-AUTH PLAIN LOGIN\r\n')
+                    await reply('250 8BITMIME')
+                elif verb == 'HELO':
+                    await reply('250 smtpsink')
+                elif verb == 'AUTH':
+                    if command.upper().startswith('AUTH LOGIN') and len(command.split()) < 3:
+                        # Username and password come on lines of their own
+                        for prompt in ('334 VXNlcm5hbWU6', '334 UGFzc3dvcmQ6'):
+                            await reply(prompt)
+                            await reader.readline()
+                    await reply('235 Authentication successful')
+                elif verb == 'MAIL':
+                    recipients = []
+                    await reply('250 OK')
+                elif verb == 'RCPT':
+                    recipients.append(command)
+                    await reply('250 OK')
+                elif verb == 'DATA':
+                    await reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    while True:
+                        line = await reader.readline()
+                        if not line or line == b'.\r\n':
+                            break
+                        data.append(line)
+                    await self.finish(reply, writer, b''.join(data))
+                    if writer.is_closing():
+                        break
+                elif verb == 'RSET':
+                    recipients = []
+                    await reply('250 OK')
+                elif verb == 'NOOP':
+                    await reply('250 OK')
+                elif verb == 'QUIT':
+                    await reply('221 Bye')
+                    break
+                else:
+                    await reply('502 Command not implemented')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def finish(self, reply, writer, message):
+        """Decide what to do with a message"""
+        if self.args.delay:
+            await asyncio.sleep(self.args.delay)
+        chance = random.random()
+        if chance < self.args.drop:
+            self.dropped += 1
+            writer.close()
+        elif chance < self.args.drop + self.args.fail4xx:
+            self.refused += 1
+            await reply('451 Temporary failure; try again later')
+        elif chance < self.args.drop + self.args.fail4xx + self.args.fail5xx:
+            self.refused += 1
+            await reply('550 Rejected')
+        else:
+            self.accepted += 1
+            if self.args.save:
+                with open(os.path.join(self.args.save, f'{self.accepted:05d}.eml'), 'wb') as f:
+                    f.write(message)
+            await reply('250 OK: queued')
+
+    def report(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        print(f'{self.accepted} accepted, {self.refused} refused, {self.dropped} dropped '
+              f'in {elapsed:.1f} seconds; at most {self.maxsessions} sessions at once')
+
+
+async def serve(args):
+    sink = Sink(args)
+    context = None
+    if args.certfile:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(args.certfile, args.keyfile)
+    server = await asyncio.start_server(sink.session, args.host, args.port, ssl=context)
+    print(f'Listening on {args.host}:{args.port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        sink.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--certfile', help='certificate, to accept SSL connections')
+    parser.add_argument('--keyfile', help='key for the certificate')
+    parser.add_argument('--fail4xx', type=float, default=0, help='fraction of messages to refuse temporarily')
+    parser.add_argument('--fail5xx', type=float, default=0, help='fraction of messages to refuse permanently')
+    parser.add_argument('--drop', type=float, default=0, help='fraction of messages to drop the connection for')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to take over each message')
+    parser.add_argument('--save', help='directory to save the messages in')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
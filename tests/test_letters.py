@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+""" The letters rendered from makemail.letter and normalmakemail.letter should be
+    the letters makemail.py and normalmakemail.py have always written.
+
+    oldmakemail() and oldnormalmakemail() are the letter-writing code the scripts
+    had before the layouts; the HTML is compared without whitespace between tags
+    (which doesn't change how it looks), and the text exactly.
+"""
+import os
+import re
+import sys
+import textwrap
+from types import SimpleNamespace
+
+import pytest
+
+sourcedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sourcedir)
+from lettertemplate import Layout
+
+parms = SimpleNamespace(rabbiemail='rabbi@example.org', rabbiname='Rabbi Cohen', adminname='Pat Office',
+                        president='Dana President')
+formurl = 'https://example.org/form?entry=1'
+emailsub = 'HHD%20Honor%202020'
+
+
+def oldmakemail(line, subhonor='', shabbatnote='', cueexp=''):
+    outhtml = []
+    outhtml.append(f'<p>Dear {line["Dear"]},</p>')
+    outhtml.append(
+        f"<p>L'shanah Tovah!  It is my great pleasure to invite you to participate in our High Holy Day services"
+        f" at Shir Hadash"
+        f" with the honor"
+        f" <b>{line['Honor']}{subhonor}</b> at the <b>{line['Service']} Service</b>"
+        f" on <b>{line['Service_Date']}</b>.")
+    if line['Sharing'] and line['Filename']:
+        outhtml.append(f"  You will be sharing this honor with {line['Sharing']}.")
+    outhtml.append('</p>')
+    if shabbatnote:
+        outhtml.append(f"<p>{shabbatnote}</p>")
+    outhtml.append('<p>I\'m pleased that we are able to recognize your special contribution to the life of our '
+                   'congregation in this way and express our appreciation for your dedication in the past year.</p>')
+    outhtml.append(f'<p>All honors will be conducted in person this year; we cannot accommodate remote honors.</p>')
+    if not 'Kulanu' in line['Service']:
+        outhtml.append(f'<p>A seat will be reserved in the Sanctuary for you in the Honorees Section for the {line["Service"]} Service.  '
+                       f'We request that you sit in your designated seat prior to and <b>after</b> your honor.</p> '
+                       )
+    outhtml.append('\n'.join(
+             ('<div id="onlyhtml">', "Please let us know if you will be able to accept this honor by:",
+             '<ul>',
+             f'<li>Responding at <a href="{formurl}">this link</a>, or</li>',
+             f'<li>Emailing <a href="mailto:honors@shirhadash.org?subject={emailsub}">honors@shirhadash.org</a></li>'
+             '</ul>',
+             '</div>')))
+    outhtml.append(
+             f'<p>If you have questions about this honor, please contact '
+             f'<a href="mailto:{parms.rabbiemail}'
+             f'?subject=Questions%20about%20High%20Holy%20Day%20Honor%20{emailsub}">'
+             f'{parms.rabbiname}</a>.</p>')
+    outhtml.append(f"<p>On {line['Holiday']}, please arrive at {line['Arrive']} ({line['Early']} minutes before"
+                   f" the beginning of the worship service) in order to meet with {line['Rabbi']},"
+                   f" who will review your participation in the service"
+                   f" and answer questions about seating and cues.</p>")
+    if line['Filename']:
+        outhtml.append('<p>Please remember to print the attached cue sheet '
+                       'and bring it with you to the service.</p>')
+        if cueexp:
+            outhtml.append(f'<p>You will read after {cueexp}.</p>')
+    if line['Explanation']:
+        outhtml.append(f'<p>{line["Explanation"]}</p>')
+    if line['FromText']:
+        outhtml.append(
+            f'<p>Your reading is in <b>{line["Book"]}</b>, <b>{line["Pages"]}</b>.  '
+            f'Read the English from "<b>{line["FromText"]}</b>" to "<b>{line["ToText"]}</b>".</p>')
+    outhtml.append('<p>We anticipate an inspiring and meaningful High Holy Day season.  '
+                   'Thank you for joining with us to add to the special flavor of our services at '
+                   'Congregation Shir Hadash.</p>')
+
+    textonly = 'Please email honors@shirhadash.org to let us know if you will be able to accept this honor.'
+    text = [re.sub(r'(?s)<div id="onlyhtml">.*?</div>', textonly, x) for x in outhtml]
+    text = [re.sub(r'<br.*?>', '\n\n', x) for x in text]
+    outtext = '\n\n'.join([textwrap.fill(re.sub(r'<.*?>', '', x), 72) for x in text])
+
+    outhtml.append(f'<p>\n<p><p>Sincerely,</p><p>\n</p><p>{parms.president}<br />President</p>')
+    outtext += f'\n\nSincerely,\n\n{parms.president}, President'
+    return ('<html>\n<body>\n<p>' + '</p>\n<p>'.join(outhtml) + '</p>\n</body>\n</html>\n', outtext)
+
+
+def oldnormalmakemail(line):
+    outhtml = []
+    outhtml.append('<p>Dear %s,</p>' % line['Dear'])
+    parts = ["<p>L'shanah Tovah!  It is my great pleasure to invite you to participate in our High Holy Day services with the honor"]
+    parts.append('<b>%s</b> at <b>%s</b> Services on <b>%s</b> at <b>%s</b>.' % (line['Honor'], line['Service'], line['Service_Date'], line['Location']))
+    if line['Sharing']:
+        parts.append('You will be joined in this honor by %s.' % line['Sharing'])
+    parts.append('</p>')
+    parts.append('<p>I\'m pleased that we are able to recognize your special contribution to the life of our congregation in this way and express our appreciation for your dedication in the past year.</p>')
+    outhtml.append(' '.join(parts))
+    parts = []
+    parts.append('<div id="onlyhtml">')
+    parts.append("Please let us know if you will be able to accept this honor by:")
+    parts.append('<ul>')
+    parts.append('<li>Responding at <a href="%s">this link</a>, or</li>' % formurl)
+    parts.append('<li>Emailing <a href="mailto:honors@shirhadash.org?subject=' + emailsub + '">honors@shirhadash.org</a>, or</li>')
+    parts.append(f'<li>Calling {parms.adminname} at the Temple Office, 408-358-1751 x7.</li>')
+    parts.append('</ul>')
+    parts.append('</div>')
+    parts.append(f'<p>If you have questions about this honor, please contact <a href="mailto:{parms.rabbiemail}?subject=Questions%20about%20High%20Holy%20Day%20Honor%20' + emailsub + f'">{parms.rabbiname}</a>.</p>')
+    outhtml.append(' '.join(parts))
+    outhtml.append('<p>On %s, please arrive at %s (%s minutes before the beginning of the worship service) in order to meet with %s, who will review your participation in the service and answer questions about seating and cues.</p>' % (line['Holiday'], line['Arrive'], line['Early'], line['Rabbi']))
+    if line['Filename']:
+        outhtml.append('<p>Please remember to print the attached cue sheet and bring it with you to the service.</p>')
+    if line['Explanation']:
+        outhtml.append('<p>%s</p>' % line['Explanation'])
+    if line['FromText']:
+        outhtml.append('<p>Your reading is in <b>%s</b>, <b>%s</b>.  Read the English from "<b>%s</b>" to "<b>%s</b>".</p>' % (line['Book'], line['Pages'], line['FromText'], line['ToText']))
+    outhtml.append('<p>We anticipate an inspiring and meaningful High Holy Day season.  Thank you for joining with us to add to the special flavor of our services at Congregation Shir Hadash.</p>')
+
+    textonly = f'Please call {parms.adminname} at the Temple Office, 408-358-1751 x7, to let us know if you will be able to accept this honor.'
+    text = [re.sub(r'<div id="onlyhtml">.*?</div>', textonly, x) for x in outhtml]
+    text = [re.sub(r'<br.*?>', '\n\n', x) for x in text]
+    outtext = '\n\n'.join([textwrap.fill(re.sub(r'<.*?>', '', x), 72) for x in text])
+
+    outhtml.append(f'<p>\n<p><p>Sincerely,</p><p>\n</p><p>{parms.president}<br />President</p>')
+    outtext += f'\n\nSincerely,\n\n{parms.president}, President'
+    return ('<html>\n<body>\n<p>' + '</p>\n<p>'.join(outhtml) + '</p>\n</body>\n</html>\n', outtext)
+
+
+def sameshape(html):
+    """The HTML, without the whitespace that doesn't matter"""
+    return re.sub(r'>\s+<', '><', ' '.join(html.split()))
+
+
+base = {'Dear': 'Jane', 'Honor': 'Torah Blessing', 'Service': 'Rosh Hashanah Morning',
+        'Service_Date': 'Monday, September 16, 2024', 'Location': 'the Sanctuary', 'Sharing': '',
+        'Filename': '', 'Holiday': 'Rosh Hashanah', 'Arrive': '9:30 AM', 'Early': '30',
+        'Rabbi': 'Rabbi Cohen', 'Explanation': '', 'FromText': '', 'ToText': '', 'Book': '', 'Pages': '',
+        'Cue': ''}
+
+rows = [
+    (dict(base), {}),
+    (dict(base, Sharing='John Smith', Filename='2020-1.pdf'),
+     dict(subhonor=' (Blessing before the Torah reading)')),
+    (dict(base, Sharing='John Smith', Filename='2020s-2.pdf', Honor='Haftarah Blessing'),
+     dict(subhonor=' (Blessing after the Haftarah reading)',
+          shabbatnote='<p>Please note the special wording for Shabbat in the blessing after the '
+                      'Haftarah reading.  Contact the Cantor if you would like a recording of '
+                      'this blessing.</p>')),
+    (dict(base, Service='Kulanu', Filename='8150.pdf', Explanation='Please come early.<br>Thank you!',
+          FromText='Our God', ToText='Amen', Book='Mishkan Hanefesh', Pages='page 12'),
+     dict(cueexp='Robert Jones')),
+]
+
+
+@pytest.mark.parametrize('line, extra', rows)
+def test_makemail_letter(line, extra):
+    layout = Layout.load(os.path.join(sourcedir, 'makemail.letter'))
+    context = dict(dict(subhonor='', shabbatnote='', cueexp=''), **extra)
+    (html, text) = layout.render(line=line, parms=parms, formurl=formurl, emailsub=emailsub, **context)
+    (oldhtml, oldtext) = oldmakemail(line, **extra)
+    assert sameshape(html) == sameshape(oldhtml)
+    assert text == oldtext
+
+
+@pytest.mark.parametrize('line, extra', rows)
+def test_normalmakemail_letter(line, extra):
+    layout = Layout.load(os.path.join(sourcedir, 'normalmakemail.letter'))
+    (html, text) = layout.render(line=line, parms=parms, formurl=formurl, emailsub=emailsub)
+    (oldhtml, oldtext) = oldnormalmakemail(line)
+    assert sameshape(html) == sameshape(oldhtml)
+    assert text == oldtext